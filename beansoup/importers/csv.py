@@ -1,11 +1,15 @@
 """Utilities to implement CSV importers."""
 
+import bisect
+import codecs
 import collections
 import csv
 import datetime
 import io
 import itertools
 import logging
+import mmap
+import os
 from os import path
 import re
 
@@ -31,6 +35,35 @@ from beansoup.utils import periods
 Row = collections.namedtuple('Row', 'lineno date description amount balance')
 
 
+# Maximum number of bytes to read from the head of a file in order to
+# find its first line.
+HEAD_MAX_BYTES = 4096
+
+# Number of bytes decoded at a time when reading a memory-mapped file.
+CHUNK_SIZE = 1024 * 1024
+
+# Maximum number of bytes to read from the head of a file in order to
+# detect its encoding.
+ENCODING_DETECT_MAX_BYTES = 64 * 1024
+
+# Byte order marks and the codecs decoding (and stripping) them; UTF-32 marks
+# must be tested before UTF-16 ones because they share a common prefix.
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+# Encodings to try, in order, on files without a byte order mark; the last
+# one can decode any sequence of bytes.
+FALLBACK_ENCODINGS = ['utf-8', 'cp1252', 'latin-1']
+
+# Supported cadences for the generation of balance directives.
+BALANCE_CADENCES = ('daily', 'weekly', 'monthly')
+
+
 class Importer(importer.ImporterProtocol):
     """An importer base class for CSV bank and credit card statements.
 
@@ -43,8 +76,11 @@ class Importer(importer.ImporterProtocol):
     See beansoup.importers.td.Importer for a full example of how to derive a
     concrete importer from this class.
     """
+    header_regexp = None
+
     def __init__(self, account, currency='CAD', basename=None,
-                 first_day=None, filename_regexp=None, account_types=None):
+                 first_day=None, filename_regexp=None, account_types=None,
+                 header_regexp=None, use_mmap=False, balance_cadence=None):
         """Create a new importer for the given account.
 
         Args:
@@ -62,26 +98,57 @@ class Importer(importer.ImporterProtocol):
             directive will be set to the day following the date of the last
             extracted entry; otherwise, it will be set to the day following the
             end of the statement period.
+          header_regexp: An optional regular expression string used to match
+            the first line of the target file. Only the first HEAD_MAX_BYTES
+            bytes of the file are read to find that line.
+          use_mmap: If True, parse the file by memory-mapping it and decoding
+            it in chunks, rather than reading its whole contents in memory;
+            useful for very large files. Derived classes should pass this
+            flag along to 'beansoup.importers.csv.parse'.
+          balance_cadence: One of 'daily', 'weekly' (periods starting on
+            Mondays), or 'monthly' (periods starting on `first_day`, or on the
+            first day of the month if `first_day` is None); if set, a balance
+            directive is generated at the start of each period following the
+            first extracted entry, up to the one following the last extracted
+            entry. If None, it defaults to 'monthly' if `first_day` is not None;
+            otherwise, only a single balance directive is generated.
         """
+        assert balance_cadence in BALANCE_CADENCES + (None,), "Invalid 'balance_cadence' value {}: expecting one of {}".format(balance_cadence, BALANCE_CADENCES)
+
         self.filename_re = re.compile(filename_regexp or self.filename_regexp)
+        header_regexp = header_regexp or self.header_regexp
+        self.header_re = re.compile(header_regexp) if header_regexp else None
         self.account = account
         self.currency = currency.upper()
         self.basename = basename
         self.first_day = first_day
         self.account_sign = atypes.get_account_sign(account, account_types)
+        self.use_mmap = use_mmap
+        if balance_cadence is None and first_day is not None:
+            balance_cadence = 'monthly'
+        self.balance_cadence = balance_cadence
 
     def name(self):
         """Include the account in the name."""
         return '{}: "{}"'.format(super().name(), self.file_account(None))
 
     def identify(self, file):
-        """Identify whether the file can be processed by this importer."""
-        # Match for a compatible MIME type.
-        if file.mimetype() != 'text/csv':
-            return False
+        """Identify whether the file can be processed by this importer.
 
+        The tests are ordered from the cheapest to the most expensive one,
+        so that most files are rejected on their name alone without ever
+        being opened.
+        """
         # Match the file name.
-        return self.filename_re.match(path.basename(file.name))
+        if not self.filename_re.match(path.basename(file.name)):
+            return False
+
+        # Match the optional header line.
+        if self.header_re and not self.header_re.match(file.convert(head_line)):
+            return False
+
+        # Match for a compatible MIME type.
+        return file.mimetype() == 'text/csv'
 
     def file_account(self, _):
         """Return the account associated with the file"""
@@ -135,7 +202,7 @@ class Importer(importer.ImporterProtocol):
         if error_lineno is not None:
             logging.warning('{}:{}: cannot reorder rows to agree with balance values'.format(
                 file.name, error_lineno))
-        elif self.first_day is None:
+        elif self.balance_cadence is None:
             # Create one single balance entry on the day following the last transaction
             last_row = rows[-1]
             date = last_row.date + datetime.timedelta(days=1)
@@ -143,17 +210,31 @@ class Importer(importer.ImporterProtocol):
                 file.name, date, last_row.balance)
             new_entries.append(balance_entry)
         else:
-            # Create monthly balance entries starting from the most recent one
-            balance_date = periods.next(periods.greatest_start(rows[-1].date,
-                                                               first_day=self.first_day))
-            for row in reversed(rows):
-                if row.date < balance_date:
-                    new_entries.append(self.create_balance_entry(
-                        file.name, balance_date, row.balance))
-                    balance_date = periods.prev(balance_date)
+            new_entries.extend(self.create_balance_entries(file.name, rows))
 
         return new_entries
 
+    def create_balance_entries(self, filename, rows):
+        """Create balance entries at the start of each period spanned by the rows.
+
+        Args:
+          filename: A string, the name of the file the rows were parsed from.
+          rows: A non-empty list of Row objects, sorted in ascending chronological
+            order in a way that agrees with their balance values.
+        Returns:
+          A list of beancount.core.data.Balance objects in ascending
+          chronological order.
+        """
+        row_dates = [row.date for row in rows]
+        balance_entries = []
+        for date in balance_dates(row_dates[0], row_dates[-1], self.balance_cadence,
+                                  first_day=self.first_day or 1):
+            # The balance at the start of a period is the one following the
+            # last row dated before it
+            row = rows[bisect.bisect_left(row_dates, date) - 1]
+            balance_entries.append(self.create_balance_entry(filename, date, row.balance))
+        return balance_entries
+
     def create_balance_entry(self, filename, date, balance):
         # Balance directives will be sorted in front of transactions, so there is no need
         # to have a line number to break ties.
@@ -184,12 +265,118 @@ class Importer(importer.ImporterProtocol):
         raise NotImplementedError('Derived classes must implement this method.')
 
 
-def parse(file, dialect, parse_row):
+def head_line(filename):
+    """A converter that reads the first line of a file.
+
+    It reads at most HEAD_MAX_BYTES bytes from the file, so it stays cheap
+    even for very large files. Being a module-level function, its result
+    is cached by cache.FileMemo.convert and shared by all the importers
+    probing the same file.
+
+    Args:
+      filename: A path string, the name of the file to read.
+    Returns:
+      A string, the first line of the file without its line terminator.
+    """
+    with open(filename, 'rb') as infile:
+        head = infile.read(HEAD_MAX_BYTES)
+    decoder = codecs.getincrementaldecoder(guess_encoding(head))(errors='ignore')
+    return decoder.decode(head).split('\n', 1)[0].rstrip('\r')
+
+
+def detect_encoding(filename):
+    """A converter that detects the encoding of a text file.
+
+    It only reads the first ENCODING_DETECT_MAX_BYTES bytes of the file; if
+    the rest of the file cannot be decoded with the guessed encoding, the
+    caller should fall back to the next candidate_encodings.
+
+    Args:
+      filename: A path string, the name of the file to read.
+    Returns:
+      A string, the name of the codec to use to decode the file.
+    """
+    with open(filename, 'rb') as infile:
+        return guess_encoding(infile.read(ENCODING_DETECT_MAX_BYTES))
+
+
+def contents(filename):
+    """A converter that reads and decodes the entire contents of a file.
+
+    Unlike beancount.ingest.cache.contents, it reads the file only once; its
+    encoding is guessed from the head of the bytes already read, falling
+    back to the next FALLBACK_ENCODINGS if the rest of the file cannot be
+    decoded.
+
+    Args:
+      filename: A path string, the name of the file to read.
+    Returns:
+      A string, the decoded contents of the file.
+    """
+    with open(filename, 'rb') as infile:
+        rawdata = infile.read()
+    encoding = guess_encoding(rawdata[:ENCODING_DETECT_MAX_BYTES])
+    for encoding in candidate_encodings(encoding):
+        try:
+            return rawdata.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+
+
+def candidate_encodings(encoding):
+    """Return the encodings to try, in order, to decode a whole file.
+
+    Args:
+      encoding: A string, the encoding guessed from the head of the file.
+    Returns:
+      A list of the guessed encoding followed by the FALLBACK_ENCODINGS
+      coming after it; the last one can decode any sequence of bytes.
+
+    Example:
+      >>> candidate_encodings('cp1252')
+      ['cp1252', 'latin-1']
+      >>> candidate_encodings('utf-16')
+      ['utf-16', 'utf-8', 'cp1252', 'latin-1']
+
+    """
+    if encoding in FALLBACK_ENCODINGS:
+        return FALLBACK_ENCODINGS[FALLBACK_ENCODINGS.index(encoding):]
+    return [encoding] + FALLBACK_ENCODINGS
+
+
+def guess_encoding(head):
+    """Guess the encoding of a text file from its first bytes.
+
+    A byte order mark, if present, determines the encoding; otherwise, the
+    first of FALLBACK_ENCODINGS able to decode the given bytes is chosen.
+
+    Args:
+      head: A bytes object, the first bytes of the file. It may end with
+        an incomplete multi-byte character.
+    Returns:
+      A string, the name of the codec to use to decode the file.
+    """
+    for bom, encoding in BOM_ENCODINGS:
+        if head.startswith(bom):
+            return encoding
+    for encoding in FALLBACK_ENCODINGS:
+        try:
+            # An incremental decoder tolerates a truncated last character
+            codecs.getincrementaldecoder(encoding)().decode(head)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+
+
+def parse(file, dialect, parse_row, use_mmap=False):
     """Parse a CSV file.
 
     This utility function makes it easy to parse a CSV file format for
     bank or credit card accounts.
 
+    It detects the encoding of the file (including any byte order mark)
+    from its first bytes and decodes it accordingly.
+
     It takes advantage of the ability to cache the file contents, but it
     does not attempt to cache the parsed result. Be careful when you consider
     caching the result of your parser in a cache.FileMemo object; often your
@@ -203,19 +390,141 @@ def parse(file, dialect, parse_row):
       dialect: The name of a registered CSV dialect to use for parsing.
       parse_row: A function taking a row (a list of values) and its line number in
         the input file and returning a Row object.
+      use_mmap: If True, bypass the cached file contents and read the lines of
+        the file with 'iter_lines' instead, so that the whole file is never
+        held in memory at once.
     Returns:
       A list of Row objects in the same order as encountered in the CSV file.
     """
-    with io.StringIO(file.contents()) as stream:
-        reader = csv.reader(stream, dialect)
-        try:
-            rows = [parse_row(row, reader.line_num) for row in reader if row]
-        except (csv.Error, ValueError) as exc:
-            logging.error('{}:{}: {}'.format(file.name, reader.line_num, exc))
-            rows = []
+    if use_mmap:
+        # The file is decoded once, unless the encoding guessed from its head
+        # fails on the rest of it; parsing then starts over with the next one
+        for encoding in candidate_encodings(file.convert(detect_encoding)):
+            try:
+                lines = iter_lines(file.name, encoding=encoding)
+                return parse_lines(file.name, lines, dialect, parse_row)
+            except UnicodeDecodeError:
+                continue
+    with io.StringIO(file.convert(contents)) as stream:
+        return parse_lines(file.name, stream, dialect, parse_row)
+
+
+def parse_lines(filename, lines, dialect, parse_row):
+    """Parse the lines of a CSV file.
+
+    Args:
+      filename: A string, the name of the file the lines come from; only
+        used to report errors.
+      lines: An iterable of strings, the lines of the CSV file.
+      dialect: The name of a registered CSV dialect to use for parsing.
+      parse_row: A function taking a row (a list of values) and its line number in
+        the input file and returning a Row object.
+    Returns:
+      A list of Row objects in the same order as encountered in the CSV file,
+      or an empty list if any row could not be parsed.
+    Raises:
+      UnicodeDecodeError: If the lines cannot be decoded.
+    """
+    reader = csv.reader(lines, dialect)
+    try:
+        rows = [parse_row(row, reader.line_num) for row in reader if row]
+    except UnicodeDecodeError:
+        raise
+    except (csv.Error, ValueError) as exc:
+        logging.error('{}:{}: {}'.format(filename, reader.line_num, exc))
+        rows = []
     return rows
 
 
+def iter_lines(filename, encoding='utf-8', chunk_size=CHUNK_SIZE):
+    """A generator of the lines of a memory-mapped text file.
+
+    The file is memory-mapped and decoded incrementally, one chunk at a time,
+    so that only a chunk of its bytes and of its decoded text are held in
+    memory at any given time, no matter how large the file is.
+
+    Args:
+      filename: A path string, the name of the file to read.
+      encoding: A string, the name of the codec used to decode the file.
+      chunk_size: An int, the number of bytes to decode at a time.
+    Yields:
+      str: the next line of the file, including its line terminator (if any).
+    """
+    pending = ''
+    for chunk in iter_chunks(filename, encoding=encoding, chunk_size=chunk_size):
+        lines = (pending + chunk).split('\n')
+        # The last line may continue in the next chunk
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def iter_chunks(filename, encoding='utf-8', chunk_size=CHUNK_SIZE):
+    """A generator of the decoded chunks of a memory-mapped text file.
+
+    Args:
+      filename: A path string, the name of the file to read.
+      encoding: A string, the name of the codec used to decode the file.
+      chunk_size: An int, the number of bytes to decode at a time.
+    Yields:
+      str: the next chunk of decoded text; a multi-byte character split
+      across two chunks of bytes is yielded with the second one.
+    Raises:
+      UnicodeDecodeError: If the file cannot be decoded with the codec; try
+        the next candidate_encodings then.
+    """
+    with open(filename, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            # Empty files cannot be memory-mapped
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            for offset in range(0, len(buffer), chunk_size):
+                yield decoder.decode(buffer[offset:offset + chunk_size])
+            yield decoder.decode(b'', final=True)
+
+
+def balance_dates(start_date, end_date, cadence, first_day=1):
+    """Compute the starting dates of the periods following the given dates.
+
+    Args:
+      start_date: A datetime.date object; the date of the first row.
+      end_date: A datetime.date object; the date of the last row.
+      cadence: One of 'daily', 'weekly' (periods starting on Mondays), or
+        'monthly' (periods starting on `first_day`).
+      first_day: An int in [1,28]; the first day of the monthly periods.
+    Returns:
+      A list of datetime.date objects in ascending chronological order,
+      from the start of the period following the one containing `start_date`
+      to the start of the period following the one containing `end_date`.
+
+    Example:
+      >>> import datetime
+      >>> [date.isoformat() for date in balance_dates(datetime.date(2016, 1, 20),
+      ...                                             datetime.date(2016, 3, 2),
+      ...                                             'monthly', first_day=15)]
+      ['2016-02-15', '2016-03-15']
+
+    """
+    if cadence == 'monthly':
+        first = periods.next(periods.greatest_start(start_date, first_day=first_day))
+        last = periods.next(periods.greatest_start(end_date, first_day=first_day))
+        return list(itertools.takewhile(lambda date: date <= last, periods.count(first)))
+
+    if cadence == 'weekly':
+        step = datetime.timedelta(days=7)
+        first = start_date + datetime.timedelta(days=7 - start_date.weekday())
+        last = end_date + datetime.timedelta(days=7 - end_date.weekday())
+    else:
+        step = datetime.timedelta(days=1)
+        first = start_date + step
+        last = end_date + step
+    num_dates = (last - first) // step + 1
+    return [first + i * step for i in range(num_dates)]
+
+
 def sort_rows(rows):
     """Sort the rows of a CSV file.
 
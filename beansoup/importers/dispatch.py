@@ -0,0 +1,193 @@
+"""An importer dispatching files to many filename-matching importers."""
+
+import bisect
+import re
+from os import path
+
+from beancount.ingest import importer
+
+from beansoup.importers import filing
+
+
+# Matches the definition of, or a back reference to, a named capturing group.
+NAMED_GROUP_RE = re.compile(r'(?<!\\)\(\?P(<|=)(\w+)')
+
+# Matches a back reference to a numbered capturing group.
+NUMBERED_BACKREF_RE = re.compile(r'(?<!\\)\\[1-9]')
+
+# The flags of a regular expression compiled without any explicit flags.
+DEFAULT_FLAGS = re.compile('').flags
+
+
+class Importer(importer.ImporterProtocol):
+    """An importer routing each file to one of many importers in a single match.
+
+    Probing each filing or CSV importer in turn costs one regular expression
+    match per importer and per file. This importer combines the filename
+    regexps of all the given importers into a single alternation, with one
+    named group per importer, so that a single match identifies the importer
+    bound to a file. The routing decision and the groups captured by the
+    match are remembered, so that file_date does not have to match the
+    filename again.
+
+    The importers are tried in the given order and the first one accepting a
+    file wins. Importers without a filename_re attribute, or whose regexp
+    cannot be safely combined with the others (e.g. it uses flags or
+    numbered back references), are probed one by one: those listed before
+    the importer found by the combined match are probed before it, and all
+    of them are probed if nothing matches. The combined match is enough to
+    accept a file for filing importers, which only match the filename;
+    other importers are also asked to identify the file.
+    """
+    def __init__(self, importers):
+        """Create a new dispatching importer.
+
+        Args:
+          importers: A list of importers; typically beansoup.importers.filing.Importer
+            and beansoup.importers.csv.Importer objects.
+        """
+        self.importers = list(importers)
+        self.combined_importers = {}
+        self.other_importers = []
+        # The positions of the other importers in the list of importers
+        self.other_indexes = []
+        patterns = []
+        for index, other in enumerate(self.importers):
+            filename_re = getattr(other, 'filename_re', None)
+            if (filename_re is None or
+                    filename_re.flags != DEFAULT_FLAGS or
+                    NUMBERED_BACKREF_RE.search(filename_re.pattern)):
+                self.other_importers.append(other)
+                self.other_indexes.append(index)
+                continue
+            name = '_{}'.format(index)
+            patterns.append('(?P<{}>{})'.format(
+                name, prefix_groups(filename_re.pattern, name + '_')))
+            self.combined_importers[name] = other
+        self.filename_re = re.compile('|'.join(patterns)) if patterns else None
+        # A map from filenames to pairs of their importer and matched groups
+        self.routes = {}
+
+    def route(self, file):
+        """Find the importer bound to the file.
+
+        Args:
+          file: A cache.FileMemo object.
+        Returns:
+          A pair of the importer accepting the file and a dict of the groups
+          matched by its filename regexp (None if the importer was probed
+          on its own), or (None, None) if no importer accepts the file.
+        """
+        try:
+            return self.routes[file.name]
+        except KeyError:
+            pass
+
+        filename = path.basename(file.name)
+        matches = self.filename_re.match(filename) if self.filename_re else None
+        if matches:
+            name = matches.lastgroup
+            other = self.combined_importers[name]
+            index = int(name[1:])
+            # The importers that could not be combined take precedence if
+            # they come first
+            route = self.probe(file, self.other_importers[
+                :bisect.bisect_left(self.other_indexes, index)])
+            if route[0] is None:
+                if is_filename_only(other) or other.identify(file):
+                    route = other, strip_groups(matches.groupdict(), name + '_')
+                else:
+                    # The filename matched, but the importer rejected the file
+                    # (e.g. it failed a header or MIME type check); fall back
+                    # to probing the remaining importers one by one.
+                    route = self.probe(file, self.importers[index + 1:])
+        else:
+            route = self.probe(file, self.other_importers)
+
+        self.routes[file.name] = route
+        return route
+
+    @staticmethod
+    def probe(file, importers):
+        """Return a route to the first of the given importers identifying the file."""
+        for other in importers:
+            if other.identify(file):
+                return other, None
+        return None, None
+
+    def name(self):
+        """Include the number of dispatched importers in the name."""
+        return '{}: {} importers'.format(super().name(), len(self.importers))
+
+    def identify(self, file):
+        """Identify whether the file can be processed by any of the importers."""
+        return self.route(file)[0] is not None
+
+    def file_account(self, file):
+        """Return the account associated with the file by its importer."""
+        other, _ = self.route(file)
+        if other:
+            return other.file_account(file)
+
+    def file_name(self, file):
+        """Return the optional renamed account file name."""
+        other, _ = self.route(file)
+        if other:
+            return other.file_name(file)
+
+    def file_date(self, file):
+        """Return the filing date for the file, reusing the filename match."""
+        other, groups = self.route(file)
+        if (isinstance(other, filing.Importer) and groups is not None and
+                type(other).file_date is filing.Importer.file_date):
+            return other.date_from_groups(groups)
+        if other:
+            return other.file_date(file)
+
+    def extract(self, file):
+        """Return the entries extracted by the importer bound to the file."""
+        other, _ = self.route(file)
+        return other.extract(file) if other else []
+
+
+def is_filename_only(other):
+    """Check whether an importer identifies files by their name only.
+
+    Args:
+      other: An importer.
+    Returns:
+      True if the importer is a filing importer whose identify method only
+      matches its filename regexp, so that a match of the combined regexp
+      is enough to accept a file.
+    """
+    return (isinstance(other, filing.Importer) and
+            type(other).identify is filing.Importer.identify)
+
+
+def prefix_groups(pattern, prefix):
+    """Add a prefix to the names of all the named groups in a regexp.
+
+    Args:
+      pattern: A regular expression string.
+      prefix: A string to prepend to the name of each named group.
+    Returns:
+      A regular expression string equivalent to the given one, but whose
+      named groups (and their back references) are renamed.
+    """
+    return NAMED_GROUP_RE.sub(
+        lambda m: '(?P{}{}{}'.format(m.group(1), prefix, m.group(2)), pattern)
+
+
+def strip_groups(groups, prefix):
+    """Select the groups with the given prefix and strip it from their names.
+
+    Args:
+      groups: A dict of named groups, as returned by re.Match.groupdict.
+      prefix: A string, the prefix of the groups to select.
+    Returns:
+      A dict mapping the original group names to the strings they matched;
+      groups that did not participate in the match are left out.
+    """
+    return {name[len(prefix):]: value
+            for name, value in groups.items()
+            if name.startswith(prefix) and value is not None}
@@ -62,24 +62,34 @@ class Importer(importer.ImporterProtocol):
         """Return the filing date for the file."""
         matches = self.filename_re.match(path.basename(file.name))
         if matches:
-            groups = matches.groupdict()
-            today = datetime.date.today()
-            year = int(groups['year']) if 'year' in groups else today.year
-            month = dates.month_number(groups.get('month')) or today.month
-            if 'day' in groups:
-                # The filename fully specifies the document date
-                day = int(groups['day'])
-                date = datetime.date(year, month, day)
+            return self.date_from_groups(matches.groupdict())
+
+    def date_from_groups(self, groups):
+        """Return the filing date for the groups matched by the filename regexp.
+
+        Args:
+          groups: A dict mapping the names of the capturing groups of the
+            filename regexp to the strings they matched.
+        Returns:
+          A datetime.date object; the end date of the period covered by the file.
+        """
+        today = datetime.date.today()
+        year = int(groups['year']) if 'year' in groups else today.year
+        month = dates.month_number(groups.get('month')) or today.month
+        if 'day' in groups:
+            # The filename fully specifies the document date
+            day = int(groups['day'])
+            date = datetime.date(year, month, day)
+        else:
+            # Use the first day of the billing cycle to compute the
+            # last day of the period for the given year and month
+            if self.first_day > 1:
+                date = (datetime.date(year, month, self.first_day) -
+                        datetime.timedelta(days=1))
             else:
-                # Use the first day of the billing cycle to compute the
-                # last day of the period for the given year and month
-                if self.first_day > 1:
-                    date = (datetime.date(year, month, self.first_day) -
-                            datetime.timedelta(days=1))
-                else:
-                    _, month_last_day = calendar.monthrange(year, month)
-                    date = datetime.date(year, month, month_last_day)
-            return date
+                _, month_last_day = calendar.monthrange(year, month)
+                date = datetime.date(year, month, month_last_day)
+        return date
 
     def extract(self, file):
         """Do not attempt to extract any transactions from the file."""
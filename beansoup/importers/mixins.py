@@ -1,5 +1,43 @@
 """Mixins for importer classes."""
 
+import collections
+import datetime
+import decimal
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import re
+import tempfile
+import time
+import types
+
+
+# Statistics about a run of a filter of a FilterChain.
+#
+# Attributes:
+#   name: A string; the name of the filter.
+#   elapsed: A float; the wall time spent in the filter, in seconds. For
+#     streaming filters, the time spent producing their input is excluded.
+#   num_in: An int; the number of entries passed to the filter.
+#   num_out: An int; the number of entries returned by the filter.
+#   num_modified: An int; the number of returned entries that were either
+#     created or modified (even in place) by the filter.
+FilterStats = collections.namedtuple('FilterStats',
+                                     'name elapsed num_in num_out num_modified')
+
+
+# The version of the format of the files written by ExtractCache; change it
+# to invalidate all existing cache files.
+CACHE_FORMAT_VERSION = 1
+
+# Number of bytes read at a time when hashing a file.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# The type of compiled regular expressions.
+PATTERN_TYPE = type(re.compile(''))
+
 
 class FilterChain:
     """A mixin to pass imported entries through a pipeline of filters.
@@ -7,6 +45,27 @@ class FilterChain:
     This mixin modifies the extract method of a concrete instance of
     ImporterProtocol to run the extracted entries through a chain of
     arbitrary filters.
+
+    There are two kinds of filters:
+
+    * batch filters (the default) are called with a list of entries and
+      return a list of entries; use them when a filter needs to see all the
+      entries at once (e.g. to sort them or to look at the last few);
+    * streaming filters, marked with the `streaming` decorator, are called
+      with an iterator of entries and return an iterable of entries;
+      typically, they are generators consuming and yielding one entry at a
+      time.
+
+    Consecutive streaming filters are pipelined, so that each entry flows
+    through all of them before the next one is extracted from the previous
+    stage; the entries are only gathered into a list when a batch filter or
+    the end of the chain is reached.
+
+    The chain can be instrumented to measure the time spent in each filter
+    and the number of entries it receives, returns, and modifies; the
+    statistics are passed to a `metrics` callback, if any, and logged at
+    the DEBUG level, if enabled. When neither is the case, the filters run
+    without any instrumentation.
     """
     def __init__(self, *args, **kwargs):
         """Set up the filter chain and pass the rest of the arguments to the
@@ -14,9 +73,13 @@ class FilterChain:
 
         Args:
           filters: A list of callables taking a list of entries and returning
-            a subset of them.
+            a subset of them, or streaming filters (see `streaming`).
+          metrics: An optional callable taking the file being extracted and a
+            list of FilterStats objects, one per filter, in order; it is called
+            at the end of each extraction.
         """
         self.filters = kwargs.pop('filters', [])
+        self.metrics = kwargs.pop('metrics', None)
         super(FilterChain, self).__init__(*args, **kwargs)
 
     def extract(self, file):
@@ -24,6 +87,380 @@ class FilterChain:
         the filters on them.
         """
         entries = super(FilterChain, self).extract(file)
+        if self.metrics or logging.getLogger().isEnabledFor(logging.DEBUG):
+            return self.extract_with_stats(file, entries)
+        for filter in self.filters:
+            if getattr(filter, 'streaming', False):
+                entries = filter(iter(entries))
+            else:
+                entries = filter(as_list(entries))
+        return as_list(entries)
+
+    def extract_with_stats(self, file, entries):
+        """Run all the filters on the extracted entries, measuring each of them.
+
+        Args:
+          file: A cache.FileMemo object; the file the entries were extracted from.
+          entries: The list of extracted entries.
+        Returns:
+          The list of filtered entries.
+        """
+        meters = []
         for filter in self.filters:
-            entries = filter(entries)
+            meter = FilterMeter(filter)
+            meters.append(meter)
+            entries = meter.run(entries)
+        entries = as_list(entries)
+
+        stats = [meter.stats() for meter in meters]
+        for filter_stats in stats:
+            logging.debug('{}: filter {}: {:.6f}s, {} in, {} out, {} modified'.format(
+                file.name, *filter_stats))
+        if self.metrics:
+            self.metrics(file, stats)
+        return entries
+
+
+class ExtractCache:
+    """A mixin caching the entries extracted by an importer on disk.
+
+    This mixin modifies the extract method of a concrete instance of
+    ImporterProtocol to store the extracted entries in a cache directory
+    and to return them without any parsing, sorting, completing, or
+    filtering the next time the same file is extracted.
+
+    A cache file is keyed by a hash of the name and contents of the extracted
+    file (the entries refer to the file by name), of the configuration of the
+    importer (its attributes, including any filters and the existing entries
+    they hold, e.g. the model transactions of a
+    beansoup.transactions.TransactionCompleter), and of an optional
+    user-provided key, typically a fingerprint of the ledger (see
+    `ledger_fingerprint`). If any of them changes, the entries are extracted
+    again. If the configuration cannot be described (see `fingerprint`),
+    the cache is bypassed.
+
+    When used together with FilterChain, list ExtractCache first among the
+    base classes, so that the filtered entries are cached.
+    """
+    def __init__(self, *args, **kwargs):
+        """Set up the cache and pass the rest of the arguments to the base class.
+
+        Args:
+          cache_dir: An optional path string, the directory storing the cache
+            files; if None, the cache is disabled.
+          cache_key: An optional string to be included in the cache key;
+            use it to invalidate the cache when data the importer depends
+            on, but does not hold, changes.
+        """
+        self.cache_dir = kwargs.pop('cache_dir', None)
+        self.cache_key = kwargs.pop('cache_key', '')
+        super(ExtractCache, self).__init__(*args, **kwargs)
+        self._config_fingerprint = None
+
+    def extract(self, file):
+        """Return the cached entries for the file, or extract and cache them."""
+        if not self.cache_dir:
+            return super(ExtractCache, self).extract(file)
+
+        try:
+            cache_filename = os.path.join(self.cache_dir, self.cache_filename(file))
+        except TypeError as exc:
+            logging.warning('{}: not caching the extracted entries: {}'.format(
+                file.name, exc))
+            return super(ExtractCache, self).extract(file)
+        try:
+            with open(cache_filename, 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, pickle.UnpicklingError) as exc:
+            logging.warning('{}: ignoring unreadable cache file {}: {}'.format(
+                file.name, cache_filename, exc))
+
+        entries = super(ExtractCache, self).extract(file)
+
+        # Write the cache file atomically, so that concurrent runs never
+        # read a partial file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, temp_filename = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                pickle.dump(entries, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_filename, cache_filename)
+        except (OSError, pickle.PicklingError) as exc:
+            logging.warning('{}: cannot write cache file {}: {}'.format(
+                file.name, cache_filename, exc))
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
         return entries
+
+    def cache_filename(self, file):
+        """Return the name of the cache file for the given file.
+
+        Args:
+          file: A cache.FileMemo object.
+        Returns:
+          A string, the basename of the cache file.
+        """
+        if self._config_fingerprint is None:
+            config = {name: value for name, value in vars(self).items()
+                      if name not in ('cache_dir', '_config_fingerprint')}
+            self._config_fingerprint = fingerprint((type(self), config))
+        key = hashlib.sha256('{}\n{}\n{}\n{}\n{}'.format(
+            CACHE_FORMAT_VERSION,
+            file.name,
+            file.convert(content_hash),
+            self._config_fingerprint,
+            self.cache_key).encode('utf-8'))
+        return key.hexdigest() + '.pickle'
+
+
+class FilterMeter:
+    """A helper measuring a run of a filter of a FilterChain."""
+    def __init__(self, filter):
+        self.filter = filter
+        self.name = getattr(filter, '__name__', type(filter).__name__)
+        self.elapsed = 0.0
+        self.upstream = 0.0
+        self.num_in = self.num_out = self.num_modified = 0
+        # A map from the ids of the input entries to their snapshots
+        self.snapshots = {}
+
+    def stats(self):
+        """Return the statistics collected so far as a FilterStats object."""
+        return FilterStats(self.name, self.elapsed - self.upstream,
+                           self.num_in, self.num_out, self.num_modified)
+
+    def run(self, entries):
+        """Run the filter on the given entries.
+
+        Streaming filters are run lazily; their statistics are complete only
+        once their output has been fully consumed.
+        """
+        if getattr(self.filter, 'streaming', False):
+            return self.metered_output(self.filter(self.metered_input(entries)))
+
+        entries = as_list(entries)
+        self.num_in = len(entries)
+        self.snapshots = {id(entry): snapshot(entry) for entry in entries}
+        start = time.perf_counter()
+        new_entries = as_list(self.filter(entries))
+        self.elapsed = time.perf_counter() - start
+        self.num_out = len(new_entries)
+        self.num_modified = sum(1 for entry in new_entries if self.is_modified(entry))
+        return new_entries
+
+    def metered_input(self, entries):
+        """Pass the input entries along, timing the production of each one."""
+        iterator = iter(entries)
+        while True:
+            start = time.perf_counter()
+            try:
+                entry = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.upstream += time.perf_counter() - start
+            self.num_in += 1
+            self.snapshots[id(entry)] = snapshot(entry)
+            yield entry
+
+    def metered_output(self, entries):
+        """Pass the output entries along, timing the production of each one."""
+        iterator = iter(entries)
+        while True:
+            start = time.perf_counter()
+            try:
+                entry = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.elapsed += time.perf_counter() - start
+            self.num_out += 1
+            if self.is_modified(entry):
+                self.num_modified += 1
+            yield entry
+
+    def is_modified(self, entry):
+        """Check whether an output entry differs from the input one, if any."""
+        return self.snapshots.pop(id(entry), None) != snapshot(entry)
+
+
+def streaming(filter):
+    """A decorator marking a filter as a streaming filter.
+
+    Args:
+      filter: A callable taking an iterator of entries and returning an
+        iterable (typically a generator) of entries.
+    Returns:
+      A callable wrapping the filter with a true `streaming` attribute.
+
+    Example:
+      >>> @streaming
+      ... def drop_balances(entries):
+      ...     return (entry for entry in entries if not hasattr(entry, 'amount'))
+      >>> drop_balances.streaming
+      True
+
+    """
+    @functools.wraps(filter)
+    def streaming_filter(entries):
+        return filter(entries)
+    streaming_filter.streaming = True
+    return streaming_filter
+
+
+def content_hash(filename):
+    """A converter computing the SHA-256 hash of the contents of a file.
+
+    Args:
+      filename: A path string, the name of the file to hash.
+    Returns:
+      A string, the hexadecimal digest of the contents of the file.
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(functools.partial(infile.read, HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ledger_fingerprint(filenames):
+    """Compute a fingerprint of a ledger from the contents of its files.
+
+    Args:
+      filenames: A list of path strings, the names of the files of the
+        ledger; e.g. options_map['include'] after loading it.
+    Returns:
+      A string, the fingerprint of the ledger; it changes whenever any of
+      its files changes.
+    """
+    digest = hashlib.sha256()
+    for filename in sorted(filenames):
+        digest.update('{}\n{}\n'.format(filename, content_hash(filename)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fingerprint(value):
+    """Return a string describing a value in the same way in every process.
+
+    Unlike repr, it does not depend on the memory addresses of objects nor
+    on the iteration order of sets, which varies with string hashing.
+
+    Args:
+      value: Any value; objects are described by their class and attributes
+        (including slots), or by the arguments and state they are pickled
+        with if they have no attributes; functions by their qualified name,
+        code, default arguments, and the contents of their closure (plus the
+        object they are bound to and the function they wrap, if any), and
+        partial objects by their function and arguments.
+    Returns:
+      A string.
+    Raises:
+      TypeError: If a value has no attributes and cannot be pickled.
+    """
+    active_ids = set()
+
+    def describe(value):
+        if value is None or isinstance(value, (bool, int, float, str, bytes,
+                                               decimal.Decimal, datetime.date)):
+            return repr(value)
+        if isinstance(value, type):
+            return '{}.{}'.format(value.__module__, value.__qualname__)
+        if isinstance(value, types.ModuleType):
+            return value.__name__
+        if isinstance(value, PATTERN_TYPE):
+            return 're.compile({!r}, {})'.format(value.pattern, value.flags)
+        if id(value) in active_ids:
+            # A reference cycle
+            return '...'
+        active_ids.add(id(value))
+        try:
+            if isinstance(value, (list, tuple)):
+                return '{}[{}]'.format(type(value).__name__,
+                                       ', '.join(map(describe, value)))
+            if isinstance(value, (set, frozenset)):
+                return 'set[{}]'.format(', '.join(sorted(map(describe, value))))
+            if isinstance(value, dict):
+                return 'dict[{}]'.format(', '.join(sorted(
+                    '{}: {}'.format(describe(key), describe(item))
+                    for key, item in value.items())))
+            if isinstance(value, functools.partial):
+                return 'partial[{}, {}, {}]'.format(
+                    describe(value.func), describe(value.args), describe(value.keywords))
+            if isinstance(value, types.CodeType):
+                return 'code[{}, {}, {}]'.format(
+                    describe(value.co_code), describe(value.co_consts),
+                    describe(value.co_names))
+            if isinstance(value, types.FunctionType):
+                return 'function[{}.{}, {}, {}, {}, {}, {}]'.format(
+                    value.__module__, value.__qualname__,
+                    describe(value.__code__),
+                    describe(value.__defaults__),
+                    describe(value.__kwdefaults__),
+                    describe([cell_contents(cell) for cell in value.__closure__ or ()]),
+                    describe(getattr(value, '__wrapped__', None)))
+            if isinstance(value, types.MethodType):
+                return 'method[{}, {}]'.format(describe(value.__func__),
+                                               describe(value.__self__))
+            if callable(value) and hasattr(value, '__qualname__'):
+                return 'function[{}.{}, {}, {}]'.format(
+                    getattr(value, '__module__', None), value.__qualname__,
+                    describe(getattr(value, '__self__', None)),
+                    describe(getattr(value, '__wrapped__', None)))
+            attributes = object_attributes(value)
+            if attributes is None:
+                # E.g. datetime.timedelta or collections.deque objects
+                reduced = value.__reduce_ex__(pickle.HIGHEST_PROTOCOL)
+                if not isinstance(reduced, tuple):
+                    raise TypeError('cannot describe {!r}'.format(value))
+                # Materialize the iterators of list and dict items
+                return '{}[{}]'.format(describe(type(value)), describe([
+                    list(part) if hasattr(part, '__next__') else part
+                    for part in reduced[1:]]))
+            return '{}[{}]'.format(describe(type(value)), describe(attributes))
+        finally:
+            active_ids.discard(id(value))
+
+    return describe(value)
+
+
+def object_attributes(value):
+    """Return the attributes of an object, including its slots.
+
+    Args:
+      value: An object.
+    Returns:
+      A dict mapping the names of the attributes to their values, or None
+      if the object has neither a __dict__ nor slots.
+    """
+    attributes = None
+    if hasattr(value, '__dict__'):
+        attributes = dict(vars(value))
+    for cls in type(value).__mro__:
+        slots = cls.__dict__.get('__slots__', ())
+        for name in [slots] if isinstance(slots, str) else slots:
+            if name not in ('__dict__', '__weakref__'):
+                if attributes is None:
+                    attributes = {}
+                if hasattr(value, name):
+                    attributes[name] = getattr(value, name)
+    return attributes
+
+
+def cell_contents(cell):
+    """Return the contents of a closure cell, or a marker if it is empty."""
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return '<empty cell>'
+
+
+def snapshot(entry):
+    """Take a shallow snapshot of an entry, catching in-place changes to its lists."""
+    return tuple(tuple(value) if isinstance(value, list) else value for value in entry)
+
+
+def as_list(entries):
+    """Return the given entries as a list, materializing them if needed."""
+    return entries if isinstance(entries, list) else list(entries)
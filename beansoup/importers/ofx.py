@@ -0,0 +1,264 @@
+"""An importer for OFX/QFX bank and credit card statements.
+
+The OFX file is never loaded as a whole, nor turned into a document tree:
+it is memory-mapped, decoded in chunks, and scanned by a streaming tokenizer
+understanding both the SGML (OFX 1.x) and the XML (OFX 2.x) flavours of
+the format.
+"""
+
+import collections
+import datetime
+import html
+import logging
+from os import path
+import re
+
+from beancount.core import data
+from beancount.core.number import D
+
+from beansoup.importers import csv
+
+
+# A statement found in an OFX file.
+#
+# Attributes:
+#   acctid: A string; the identifier of the account of the statement, or None.
+#   currency: A string; the default currency of the statement, or None.
+#   rows: A list of beansoup.importers.csv.Row objects in the order they are
+#     found in the file; their line number is their position in the statement
+#     and their balance is None.
+#   balance: A beancount.core.number.Decimal object; the ledger balance of the
+#     account at the end of the statement, or None if not available.
+Statement = collections.namedtuple('Statement', 'acctid currency rows balance')
+
+
+# Matches a tag and the text following it, up to the next tag.
+TOKEN_RE = re.compile(r'<(/?)([^>\s/]+)[^>]*>([^<]*)')
+
+# Tags of the aggregates containing a banking or credit card statement.
+STATEMENT_TAGS = frozenset(['STMTRS', 'CCSTMTRS'])
+
+
+class Importer(csv.Importer):
+    """An importer for OFX/QFX bank and credit card statements.
+
+    It follows the conventions of beansoup.importers.csv.Importer: it is
+    bound to an account, it files documents according to the `first_day`
+    of their billing period, and it generates balance directives from the
+    ledger balance reported by the statement.
+    """
+    filename_regexp = r'^.*\.([oOqQ][fF][xX])$'
+    header_regexp = r'^\s*(OFXHEADER:|<\?xml|<OFX>)'
+
+    def __init__(self, *args, acctid=None, **kwargs):
+        """Create a new importer for the given account.
+
+        Args:
+          acctid: An optional string, the identifier of the account (ACCTID)
+            whose statement should be imported; if None, the first statement
+            found in the file is imported.
+          Any other argument accepted by beansoup.importers.csv.Importer.
+        """
+        super().__init__(*args, **kwargs)
+        self.acctid = acctid
+
+    def identify(self, file):
+        """Identify whether the file can be processed by this importer.
+
+        OFX files do not have a reliable MIME type, so only their name and
+        their first line are checked.
+        """
+        if not self.filename_re.match(path.basename(file.name)):
+            return False
+        if not self.header_re.match(file.convert(csv.head_line)):
+            return False
+        if self.acctid is None:
+            return True
+        return self.find_statement(file) is not None
+
+    def extract(self, file):
+        """Return extracted entries and errors."""
+        entries = super().extract(file)
+        statement = self.find_statement(file)
+        if statement and statement.currency and statement.currency.upper() != self.currency:
+            logging.warning('{}: the statement is in {}, but its entries are in {}'.format(
+                file.name, statement.currency, self.currency))
+        if statement and statement.balance is None:
+            # The balances of the rows are only relative to each other
+            logging.warning('{}: no ledger balance; cannot extract balance directives'.format(
+                file.name))
+            entries = [entry for entry in entries if not isinstance(entry, data.Balance)]
+        return entries
+
+    def find_statement(self, file):
+        """Find the statement to import.
+
+        Args:
+          file: A cache.FileMemo object.
+        Returns:
+          A Statement object or None if the file has no matching statement.
+        """
+        for statement in file.convert(parse_statements):
+            if self.acctid is None or statement.acctid == self.acctid:
+                return statement
+
+    def parse(self, file):
+        """Parse the statement of an OFX file.
+
+        Args:
+          file: A cache.FileMemo object.
+        Returns:
+          A list of Row objects in ascending chronological order; their
+          balances are computed backwards from the ledger balance of the
+          statement (or from zero, if the statement does not have one).
+        """
+        statement = self.find_statement(file)
+        if statement is None:
+            return []
+        rows = sorted(statement.rows, key=lambda row: row.date)
+        balance = statement.balance or D()
+        for index in reversed(range(len(rows))):
+            rows[index] = rows[index]._replace(balance=balance)
+            balance -= rows[index].amount
+        return rows
+
+
+def parse_statements(filename):
+    """A converter that parses all the statements of an OFX file.
+
+    The rows of an OFX file do not depend on the importer parsing them (the
+    amounts are already signed from the point of view of the account holder),
+    so it is safe to cache the result of this converter in a cache.FileMemo
+    object and share it among importers.
+
+    The file is decoded once, unless the encoding guessed from its head
+    fails on the rest of it; parsing then starts over with the next one.
+
+    Args:
+      filename: A path string, the name of the OFX file.
+    Returns:
+      A list of Statement objects in the order they are found in the file.
+    """
+    for encoding in csv.candidate_encodings(csv.detect_encoding(filename)):
+        try:
+            return parse_chunks(filename, csv.iter_chunks(filename, encoding=encoding))
+        except UnicodeDecodeError:
+            continue
+
+
+def parse_chunks(filename, chunks):
+    """Parse all the statements of the decoded chunks of an OFX file.
+
+    Args:
+      filename: A path string, the name of the OFX file; only used to report
+        errors.
+      chunks: An iterable of strings, the consecutive chunks of text of the
+        file.
+    Returns:
+      A list of Statement objects in the order they are found in the file.
+    Raises:
+      UnicodeDecodeError: If the chunks cannot be decoded.
+    """
+    statements = []
+    statement = txn = None
+    in_ledger_balance = False
+    try:
+        for closing, tag, value in iter_tokens(chunks):
+            if closing:
+                if tag == 'STMTTRN' and txn is not None:
+                    statement['rows'].append(create_row(len(statement['rows']) + 1, txn))
+                    txn = None
+                elif tag == 'LEDGERBAL':
+                    in_ledger_balance = False
+                elif tag in STATEMENT_TAGS and statement is not None:
+                    statements.append(Statement(**statement))
+                    statement = None
+            elif tag in STATEMENT_TAGS:
+                statement = dict(acctid=None, currency=None, rows=[], balance=None)
+            elif statement is None:
+                continue
+            elif tag == 'STMTTRN':
+                txn = {}
+            elif tag == 'LEDGERBAL':
+                in_ledger_balance = True
+            elif txn is not None:
+                txn[tag] = value
+            elif in_ledger_balance:
+                if tag == 'BALAMT':
+                    statement['balance'] = parse_amount(value)
+            elif tag == 'ACCTID':
+                statement['acctid'] = value
+            elif tag == 'CURDEF':
+                statement['currency'] = value
+    except UnicodeDecodeError:
+        raise
+    except (KeyError, ValueError) as exc:
+        logging.error('{}: {}'.format(filename, exc))
+        return []
+    return statements
+
+
+def create_row(index, txn):
+    """Create a row from the elements of an OFX transaction.
+
+    Args:
+      index: An int, the position of the transaction in its statement.
+      txn: A dict mapping the tags of the elements of a STMTTRN aggregate
+        to their values.
+    Returns:
+      A beansoup.importers.csv.Row object with a None balance.
+    """
+    date = datetime.datetime.strptime(txn['DTPOSTED'][:8], '%Y%m%d').date()
+    name, memo = txn.get('NAME'), txn.get('MEMO')
+    if name and memo and name != memo:
+        description = '{} / {}'.format(name, memo)
+    else:
+        description = name or memo or ''
+    return csv.Row(index, date, description, parse_amount(txn['TRNAMT']), None)
+
+
+def parse_amount(string):
+    """Parse an OFX amount; some institutions use a comma as decimal separator."""
+    return D(string.replace(',', '.'))
+
+
+def iter_tokens(chunks):
+    """A generator of the tokens of an OFX file.
+
+    It understands both SGML (with unterminated elements) and XML files.
+    Processing instructions, comments, and the plain-text headers of OFX 1.x
+    files are skipped.
+
+    Args:
+      chunks: An iterable of strings, the consecutive chunks of text of the
+        file; tags can be split across chunks.
+    Yields:
+      A tuple of a bool (True for closing tags), a string (the tag name, in
+      uppercase), and a string (the stripped and unescaped text following
+      the tag).
+
+    Example:
+      >>> list(iter_tokens(['<STMTTRN><TRN', 'AMT>-1.50\\n</STMTTRN>']))
+      [(False, 'STMTTRN', ''), (False, 'TRNAMT', '-1.50'), (True, 'STMTTRN', '')]
+
+    """
+    pending = ''
+    for chunk in chunks:
+        text = pending + chunk
+        # The text following the last tag may continue in the next chunk
+        end = text.rfind('<')
+        if end == -1:
+            pending = text
+            continue
+        yield from tokenize(text[:end])
+        pending = text[end:]
+    yield from tokenize(pending)
+
+
+def tokenize(text):
+    """A generator of the tokens of a piece of OFX text ending on a tag boundary."""
+    for match in TOKEN_RE.finditer(text):
+        closing, tag, value = match.groups()
+        if tag[0] in '?!':
+            continue
+        yield bool(closing), tag.upper(), html.unescape(value.strip())
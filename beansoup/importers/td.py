@@ -21,7 +21,7 @@ class Importer(csv.Importer):
         Returns:
           A list of Row objects.
         """
-        return csv.parse(file, 'tdcanadatrust', self.parse_row)
+        return csv.parse(file, 'tdcanadatrust', self.parse_row, use_mmap=self.use_mmap)
 
     def parse_row(self, row, lineno):
         """Parse a row of a TD Canada Trust CSV file.
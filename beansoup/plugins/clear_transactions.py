@@ -2,42 +2,96 @@
 """
 
 import argparse
+import bisect
 import collections
 import datetime
+import hashlib
 import itertools
+import json
+import logging
+import os
+import tempfile
 
 from beancount.core import data, getters, flags
 
 from beansoup.plugins import config
-from beansoup.utils import dates
+from beansoup.utils import rewrites
 
 __plugins__ = ('clear_transactions',)
 
 
-class AccountPairType:
-    def __init__(self, entries):
-        self.existing_accounts = getters.get_accounts(entries)
+def account_pair_type(string):
+    """Argument type for pairs of clearing and main account names.
 
-    def __call__(self, string):
-        accounts = string.split(',')
-        if len(accounts) != 2:
-            msg = "invalid account pair: '{}'; expecting clearing and main account names separated by a comma (no spaces)".format(string)
-            raise argparse.ArgumentTypeError(msg)
-        for account in accounts:
-            if account not in self.existing_accounts:
-                msg = "account '{}' does not exist".format(account)
-                raise argparse.ArgumentTypeError(msg)
-        return tuple(accounts)
+    The existence of the accounts is not checked here, to avoid an extra
+    pass over the entries; see Processor.group_txn_postings().
+    """
+    accounts = string.split(',')
+    if len(accounts) != 2:
+        msg = "invalid account pair: '{}'; expecting clearing and main account names separated by a comma (no spaces)".format(string)
+        raise argparse.ArgumentTypeError(msg)
+    return tuple(accounts)
 
 
 def clear_transactions(entries, options_map, config_string):
+    """Tag cleared and pending transactions.
+
+    The input list of entries is left untouched; the modified transactions
+    are patched into a copy of it.
+    """
+    return clear_transactions_in_place(list(entries), options_map, config_string)
+
+
+def clear_transactions_in_place(entries, options_map, config_string):
+    """Tag cleared and pending transactions, replacing them in the list.
+
+    The cost of this function, beyond a single scan of the entries, is
+    proportional to the number of transactions to clearing accounts.
+
+    Args:
+      entries: A list of directives; it is modified in place.
+      options_map: A dict of options parsed from the file.
+      config_string: A string, the configuration of the plugin.
+    Returns:
+      A pair of the list of entries and a list of errors.
+    """
     # Parse plugin config; report errors if any
+    try:
+        parser, args = parse_config(config_string, options_map)
+    except config.ParseError as error:
+        return entries, [error]
+
+    processor = Processor(args)
+
+    groups, existing_accounts = processor.group_txn_postings(entries)
+    try:
+        check_accounts(parser, args, existing_accounts)
+    except config.ParseError as error:
+        return entries, [error]
+
+    modified_entries, errors = processor.clear_transactions(groups)
+
+    # FIXME: Consider printing the pending entries. Maybe return errors for them.
+
+    for index, entry in modified_entries.items():
+        entries[index] = entry
+    return entries, errors
+
+
+def create_parser(entries_filename):
+    """Create the parser of the configuration of the plugin.
+
+    Args:
+      entries_filename: A string, the name of the ledger file.
+    Returns:
+      A beansoup.plugins.config.ArgumentParser object.
+    """
     parser = config.ArgumentParser(
         prog=__name__,
         description='A plugin that automatically tags cleared and pending transactions.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         add_help=False,
-        entries_filename=options_map['filename'])
+        entries_filename=entries_filename)
     parser.add_argument(
         '--flag_pending', action='store_true', default=False,
         help='annotate pending transactions with a {} flag'.format(flags.FLAG_WARNING))
@@ -59,23 +113,75 @@ def clear_transactions(entries, options_map, config_string):
     parser.add_argument(
         '--skip_weekends', action='store_true', default=False,
         help='skip weekends when measuring the time gap between transactions')
+    parser.add_argument(
+        '--optimal_matching', action='store_true', default=False,
+        help='pair transactions to minimize the number of pending ones and the total time gap between pairs, rather than pairing each transaction with the first match')
+    parser.add_argument(
+        '--max_split', metavar='N', type=int, default=1,
+        help='also clear a transaction left unpaired together with up to %(metavar)s transactions whose amounts add up to its opposite')
+    parser.add_argument(
+        '--state_file', metavar='FILE', default=None,
+        help='remember in %(metavar)s (relative to the ledger) how transactions too old to be affected by new ones were cleared, and only process the recent ones on the next load')
     parser.add_argument(
         'account_pairs', metavar='CLEARING_ACCOUNT,MAIN_ACCOUNT', nargs='+',
-        type=AccountPairType(entries),
+        type=account_pair_type,
         help='the names of a clearing account and its main account, separated by a comma (no space)')
 
-    try:
-        args = parser.parse_args((config_string or '').split())
-    except config.ParseError as error:
-        return entries, [error]
+    return parser
 
-    processor = Processor(args)
 
-    modified_entries, errors = processor.clear_transactions(entries)
+def parse_config(config_string, options_map):
+    """Parse the configuration of the plugin.
 
-    # FIXME: Consider printing the pending entries. Maybe return errors for them.
+    Args:
+      config_string: A string, the configuration of the plugin.
+      options_map: A dict of options parsed from the file.
+    Returns:
+      A pair of the ArgumentParser object, as returned by create_parser(),
+      and an argparse.Namespace object.
+    Raises:
+      beansoup.plugins.config.ParseError: If the configuration is invalid.
+    """
+    parser, args = config.parse_args(create_parser, options_map['filename'], config_string)
+    if args.state_file:
+        args.state_file = os.path.join(os.path.dirname(options_map['filename']), args.state_file)
+    return parser, args
+
+
+def check_accounts(parser, args, existing_accounts):
+    """Check that the configured accounts exist.
+
+    Args:
+      parser: An ArgumentParser object, as returned by parse_config().
+      args: An argparse.Namespace object, as returned by parse_config().
+      existing_accounts: A collection of the names of the accounts used by
+        the entries.
+    Raises:
+      beansoup.plugins.config.ParseError: If an account does not exist.
+    """
+    for account in itertools.chain.from_iterable(args.account_pairs):
+        if account not in existing_accounts:
+            parser.error("argument CLEARING_ACCOUNT,MAIN_ACCOUNT: account '{}' does not exist".format(account))
+
+
+# The transactions of a clearing account, sorted chronologically, and their
+# properties, indexed by their position.
+#
+# Attributes:
+#   txn_postings: A list of beancount.core.data.TxnPosting objects; the
+#     transactions and their posting to the clearing account.
+#   dates: A list of datetime.date objects; the dates of the transactions.
+#   max_dates: A list of datetime.date objects; the latest date of a
+#     transaction that can be matched to each transaction.
+#   num_main_postings: A list of ints; the number of postings of each
+#     transaction to the main account related to the clearing account.
+Group = collections.namedtuple('Group', 'txn_postings dates max_dates num_main_postings')
+
+# The choices made while aligning red and blue transactions.
+SKIP_RED, SKIP_BLUE, MATCH = range(3)
 
-    return [modified_entries.get(id(entry), entry) for entry in entries], errors
+# The version of the format of the state file; bump it on incompatible changes.
+STATE_FORMAT_VERSION = 2
 
 
 class Processor:
@@ -87,91 +193,593 @@ class Processor:
         self.cleared_link_prefix = args.link_prefix
         self.max_delta_days = args.max_days
         self.skip_weekends = args.skip_weekends
+        if self.skip_weekends:
+            # Only imported with --skip_weekends; it builds tables of month
+            # names on import
+            from beansoup.utils import dates
+            self.add_biz_days = dates.add_biz_days
+        self.optimal_matching = args.optimal_matching
+        self.max_split = args.max_split
         self.clearing_accounts = dict(args.account_pairs)
+        self.state_filename = args.state_file
+        # The options a state file must have been saved with to be reused
+        self.options = {name: value for name, value in vars(args).items()
+                        if name not in ('state_file', 'account_pairs')}
+        self.options['account_pairs'] = [list(pair) for pair in args.account_pairs]
 
         self.modified_entries = None
+        # The tags, links, and flags added to the transactions, applied once
+        # all the groups are cleared
+        self.rewriter = None
+        # The positions of the grouped transactions, by their id
+        self.entry_indexes = {}
+        # The link name of each cleared transaction and None for each
+        # pending one, by their id
+        self.outcomes = None
         self.link_count = itertools.count(start=1)
 
-    def clear_transactions(self, entries):
-        errors = []
-        self.modified_entries = {}
+    def group_txn_postings(self, entries):
+        """Group the postings to the clearing accounts by account.
+
+        The accounts used by the entries are gathered in the same pass, so
+        that the configured accounts can be validated without scanning the
+        entries again.
+
+        Args:
+          entries: A list of directives.
+        Returns:
+          A pair of a dict mapping the names of the clearing accounts to lists
+          of beancount.core.data.TxnPosting objects, and the set of the names
+          of all the accounts used by the entries.
+        """
         groups = collections.defaultdict(list)
-        for entry in entries:
-            if (not isinstance(entry, data.Transaction) or
-                    (entry.tags and self.ignored_tag_name in entry.tags)):
-                continue
-            posting = self.get_txn_clearing_posting(entry)
-            if posting:
+        accounts = set()
+        for index, entry in enumerate(entries):
+            if isinstance(entry, data.Transaction):
+                accounts.update([posting.account for posting in entry.postings])
+            else:
+                accounts.update(getters.get_entry_accounts(entry))
+            self.add_entry(groups, index, entry)
+        return groups, accounts
+
+    def add_entry(self, groups, index, entry):
+        """Add an entry to the group of its clearing account, if any.
+
+        Args:
+          groups: A dict mapping the names of the clearing accounts to lists
+            of beancount.core.data.TxnPosting objects; it is updated.
+          index: An int, the position of the entry.
+          entry: A directive.
+        Returns:
+          True if the entry was added to a group.
+        """
+        if (not isinstance(entry, data.Transaction) or
+                (entry.tags and self.ignored_tag_name in entry.tags)):
+            return False
+        # This code implicitly assumes that a transaction can only have
+        # one posting to a clearing account
+        for posting in entry.postings:
+            if posting.account in self.clearing_accounts:
                 groups[posting.account].append(data.TxnPosting(entry, posting))
+                self.entry_indexes[id(entry)] = index
+                return True
+        return False
+
+    def clear_transactions(self, groups):
+        """Clear the grouped transactions.
+
+        If a state file is configured, the transactions frozen in it are
+        restored as they were cleared, and only the other ones are processed;
+        the state file is then updated.
 
+        Args:
+          groups: A dict of lists of TxnPosting objects, as returned by
+            group_txn_postings().
+        Returns:
+          A pair of a dict mapping the positions of the modified transactions
+          in the grouped entries to their new version, and a list of errors.
+        """
+        errors = []
+        self.rewriter = rewrites.EntryRewriter()
+        self.outcomes = {}
+        state = self.load_state() if self.state_filename else {}
+        new_state = {}
         # NOTE: sorting is only needed to support testing
-        for _, txn_postings in sorted(groups.items(), key=lambda x: x[0]):
-            self.clear_transaction_group(txn_postings)
+        sorted_groups = []
+        for account, txn_postings in sorted(groups.items(), key=lambda x: x[0]):
+            txn_postings = sorted(txn_postings, key=lambda x: data.entry_sortkey(x.txn))
+            keys = txn_keys(txn_postings)
+            frozen_positions = set()
+            if account in state:
+                frozen_positions = self.restore_group(state[account], txn_postings, keys)
+            sorted_groups.append((account, txn_postings, keys, frozen_positions))
+
+        # Never reuse the name of a restored link; the other links are then
+        # numbered the same way on every load
+        restored_links = [name for name in self.outcomes.values() if name]
+        self.link_count = itertools.count(
+            start=max(link_numbers(restored_links), default=0) + 1)
+        for account, txn_postings, keys, frozen_positions in sorted_groups:
+            self.clear_transaction_group([
+                txn_posting for position, txn_posting in enumerate(txn_postings)
+                if position not in frozen_positions])
+            if self.state_filename:
+                new_state[account] = self.freeze_group(txn_postings, keys)
 
+        if self.state_filename:
+            self.save_state(new_state)
+
+        self.modified_entries = {
+            self.entry_indexes[id(txn)]: new_txn
+            for txn, new_txn in self.rewriter.rewrite_all()}
         return self.modified_entries, errors
 
-    def get_txn_clearing_posting(self, txn):
-        # This code implicitly assumes that a transaction can only have
-        # one posting to a clearing account
-        for posting in txn.postings:
-            if posting.account in self.clearing_accounts:
-                return posting
+    def load_state(self):
+        """Load the state file.
+
+        Returns:
+          A dict mapping the names of clearing accounts to their frozen state,
+          as returned by freeze_group(); it is empty if the state file does
+          not exist, cannot be read, or was saved with different options.
+        """
+        try:
+            with open(self.state_filename) as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            logging.warning('{}: cannot read state file: {}'.format(self.state_filename, exc))
+            return {}
+        if state.get('version') != STATE_FORMAT_VERSION or state.get('options') != self.options:
+            return {}
+        return state['accounts']
+
+    def save_state(self, accounts_state):
+        """Save the state file atomically.
+
+        Args:
+          accounts_state: A dict mapping the names of clearing accounts to
+            their frozen state, as returned by freeze_group().
+        """
+        state = dict(version=STATE_FORMAT_VERSION,
+                     options=self.options,
+                     accounts=accounts_state)
+        state_dir = os.path.dirname(self.state_filename) or '.'
+        fd, temp_filename = tempfile.mkstemp(dir=state_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as temp_file:
+                json.dump(state, temp_file, indent=1, sort_keys=True)
+            os.replace(temp_filename, self.state_filename)
+        except OSError as exc:
+            logging.warning('{}: cannot write state file: {}'.format(self.state_filename, exc))
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+    def restore_group(self, group_state, txn_postings, keys):
+        """Clear the frozen transactions of a clearing account as they were.
+
+        The state is only reused if it is consistent with the transactions:
+        all the frozen transactions must still exist, and no transaction
+        must have been added or changed before the last one seen when the
+        state was saved.
+
+        Args:
+          group_state: A dict, the frozen state of the clearing account, as
+            returned by freeze_group().
+          txn_postings: A list of TxnPosting objects in ascending
+            chronological order.
+          keys: A list of strings, the keys of the transactions.
+        Returns:
+          A set of the positions of the restored transactions.
+        """
+        positions = {key: position for position, key in enumerate(keys)}
+        links = group_state['links']
+        frozen_keys = set(group_state['pending']).union(*links.values())
+        if not frozen_keys.issubset(positions):
+            return set()
+        known_keys = frozen_keys.union(group_state['recent'])
+        last_date = datetime.datetime.strptime(group_state['last_date'], '%Y-%m-%d').date()
+        for txn_posting, key in zip(txn_postings, keys):
+            if txn_posting.txn.date > last_date:
+                break
+            if key not in known_keys:
+                return set()
+
+        for link_name, link_keys in sorted(links.items()):
+            self.clear_txn_postings([txn_postings[positions[key]] for key in link_keys],
+                                    link_name)
+        for key in group_state['pending']:
+            self.mark_pending(txn_postings[positions[key]])
+        return {positions[key] for key in frozen_keys}
+
+    def freeze_group(self, txn_postings, keys):
+        """Return the frozen state of a clearing account.
+
+        A transaction is frozen if its matching window ends before the date
+        of the last transaction, so that transactions added later on cannot
+        change how it is cleared; the transactions it is linked to must be
+        frozen too.
+
+        With optimal matching or split matches, a new transaction can change
+        how earlier ones are paired through a chain of overlapping matching
+        windows; only the transactions before the last gap between windows
+        are then frozen.
+
+        Args:
+          txn_postings: A list of cleared TxnPosting objects in ascending
+            chronological order.
+          keys: A list of strings, the keys of the transactions.
+        Returns:
+          A dict with the date of the last transaction, the keys of the
+          frozen transactions by link name, the keys of the frozen pending
+          transactions, and the keys of the transactions that are not frozen.
+        """
+        last_date = txn_postings[-1].txn.date
+        max_dates = [self.max_matching_date(txn_posting.txn) for txn_posting in txn_postings]
+        if self.optimal_matching or self.max_split > 1:
+            # Find the first transaction chained to the last one
+            start = len(txn_postings) - 1
+            while start > 0 and max_dates[start - 1] >= txn_postings[start].txn.date:
+                start -= 1
+        else:
+            start = len(txn_postings)
+        links = collections.defaultdict(list)
+        frozen_links = collections.defaultdict(lambda: True)
+        pending = []
+        recent = []
+        for position, (txn_posting, key) in enumerate(zip(txn_postings, keys)):
+            link_name = self.outcomes[id(txn_posting.txn)]
+            frozen = max_dates[position] < last_date and position < start
+            if link_name is not None:
+                links[link_name].append(key)
+                frozen_links[link_name] &= frozen
+            elif frozen:
+                pending.append(key)
+            else:
+                recent.append(key)
+        for link_name, frozen in frozen_links.items():
+            if not frozen:
+                recent.extend(links.pop(link_name))
+        return dict(last_date=last_date.isoformat(),
+                    links=links, pending=pending, recent=recent)
 
     def clear_transaction_group(self, txn_postings):
         # Make sure the transactions are sorted;
         # other plugins could have changed their order
-        txn_postings = collections.deque(
-            sorted(txn_postings, key=lambda x: data.entry_sortkey(x.txn)))
+        txn_postings = sorted(txn_postings, key=lambda x: data.entry_sortkey(x.txn))
+        group = Group(
+            txn_postings,
+            [txn_posting.txn.date for txn_posting in txn_postings],
+            [self.max_matching_date(txn_posting.txn) for txn_posting in txn_postings],
+            [self.count_main_account_postings(txn_posting) for txn_posting in txn_postings])
+
+        if self.optimal_matching:
+            matches = self.match_optimally(group)
+        else:
+            matches = self.match_greedily(group)
+        matched = set(itertools.chain.from_iterable(matches))
+        if self.max_split > 1:
+            matches.extend(self.match_splits(group, matched))
+
+        # Link the matches in the order of their first transaction, as the
+        # greedy matching would
+        for positions in sorted(matches):
+            self.clear_txn_postings([txn_postings[position] for position in positions])
+        for position, txn_posting in enumerate(txn_postings):
+            if position not in matched:
+                # No match; mark the transaction as pending
+                self.mark_pending(txn_posting)
 
-        while txn_postings:
-            txn_posting = txn_postings.popleft()
-            if id(txn_posting.txn) in self.modified_entries:
+    def match_greedily(self, group):
+        """Pair each transaction with the first later one it can be matched to.
+
+        Args:
+          group: A Group object.
+        Returns:
+          A list of pairs of positions of matched transactions.
+        """
+        # An index from units to the positions (in ascending order) of the
+        # postings still waiting to be cleared
+        open_positions = collections.defaultdict(list)
+        for position, txn_posting in enumerate(group.txn_postings):
+            open_positions[txn_posting.posting.units].append(position)
+
+        pairs = []
+        matched = [False] * len(group.txn_postings)
+        for position, txn_posting in enumerate(group.txn_postings):
+            if matched[position]:
                 # This transaction has already been cleared
                 continue
-            # Look for matching transactions within a maximum time delta
-            max_date = self.max_matching_date(txn_posting.txn)
-            for txn_posting2 in itertools.takewhile(lambda x: x.txn.date <= max_date, txn_postings):
-                if id(txn_posting2.txn) in self.modified_entries:
-                    # This transaction has already been cleared
-                    continue
-                if self.match_txn_postings(txn_posting, txn_posting2):
-                    # Found match; link the transactions and tag them as cleared
-                    link_name = '{}-{}'.format(self.cleared_link_prefix,
-                                               next(self.link_count))
-                    txn = txn_posting.txn
-                    self.modified_entries[id(txn)] = txn._replace(
-                        tags=(txn.tags or set()) | set((self.cleared_tag_name,)),
-                        links=(txn.links or set()) | set((link_name,)))
-                    txn2 = txn_posting2.txn
-                    self.modified_entries[id(txn2)] = txn2._replace(
-                        tags=(txn2.tags or set()) | set((self.cleared_tag_name,)),
-                        links=(txn2.links or set()) | set((link_name,)))
+            # Look for the first matching transaction within a maximum time
+            # delta; the postings to the clearing account on the two
+            # transactions must balance out to 0
+            candidates = open_positions.get(-txn_posting.posting.units, [])
+            for index in range(bisect.bisect_right(candidates, position), len(candidates)):
+                position2 = candidates[index]
+                if group.dates[position2] > group.max_dates[position]:
                     break
-            else:
-                # No match; mark the transaction as pending
-                txn = txn_posting.txn
-                self.modified_entries[id(txn)] = txn._replace(
-                    flag=flags.FLAG_WARNING if self.flag_pending else txn.flag,
-                    tags=(txn.tags or set()) | set((self.pending_tag_name,)))
+                # We can have a match only if one and only one of the two
+                # transactions has a posting to the main account related
+                # to their common clearing account
+                if group.num_main_postings[position] + group.num_main_postings[position2] == 1:
+                    del candidates[index]
+                    pairs.append((position, position2))
+                    matched[position2] = True
+                    break
+        return pairs
+
+    def match_optimally(self, group):
+        """Pair transactions to maximize the number of matches and, among all
+        maximal matchings, minimize the total time gap between paired
+        transactions.
+
+        The transactions without postings to the main account (red) can only
+        be matched to transactions with one posting to the main account
+        (blue) and opposite units, so each set of red transactions sharing
+        the same units can be matched independently.
+
+        On a line, if red transactions r1 <= r2 can be matched to blue
+        transactions b1 <= b2 as (r1, b2) and (r2, b1), they can also be
+        matched as (r1, b1) and (r2, b2) with no larger total gap. Hence,
+        there always is an optimal matching preserving the chronological
+        order of both colors; it is found by an alignment of the two
+        sequences, like a longest common subsequence, where each red
+        transaction only needs to be compared to the narrow band of blue
+        transactions within its time window.
+
+        Args:
+          group: A Group object.
+        Returns:
+          A list of pairs of positions of matched transactions.
+        """
+        reds = collections.defaultdict(list)
+        blues = collections.defaultdict(list)
+        for position, txn_posting in enumerate(group.txn_postings):
+            num_main_postings = group.num_main_postings[position]
+            if num_main_postings == 0:
+                reds[txn_posting.posting.units].append(position)
+            elif num_main_postings == 1:
+                blues[-txn_posting.posting.units].append(position)
+
+        pairs = []
+        for units, red_positions in reds.items():
+            if units in blues:
+                pairs.extend(align(group, red_positions, blues[units]))
+        return [tuple(sorted(pair)) for pair in pairs]
+
+    def match_splits(self, group, matched):
+        """Match each transaction to a set of transactions whose postings to
+        the clearing account add up to the opposite of its own.
+
+        The postings in the time window of a transaction are searched for the
+        smallest set, of at most max_split postings, cancelling it out.
+
+        Args:
+          group: A Group object.
+          matched: A set of positions of transactions that are already
+            matched; it is updated with the newly matched ones.
+        Returns:
+          A list of tuples of positions of matched transactions, in
+          ascending order.
+        """
+        matches = []
+        for position, txn_posting in enumerate(group.txn_postings):
+            if position in matched or group.num_main_postings[position] > 1:
+                continue
+            units = txn_posting.posting.units
+            # The transactions that could be paired with this one, if only
+            # their amounts matched
+            lo = bisect.bisect_left(group.max_dates, group.dates[position])
+            hi = bisect.bisect_right(group.dates, group.max_dates[position])
+            candidates = []
+            for position2 in range(lo, hi):
+                units2 = group.txn_postings[position2].posting.units
+                if (position2 not in matched and
+                        group.num_main_postings[position] + group.num_main_postings[position2] == 1 and
+                        units2.currency == units.currency and
+                        units2.number * units.number < 0):
+                    candidates.append((abs(units2.number), position2))
+            candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+            subset = find_subset([amount for amount, _ in candidates],
+                                 abs(units.number), self.max_split)
+            if subset is not None:
+                positions = tuple(sorted([position] + [candidates[index][1] for index in subset]))
+                matches.append(positions)
+                matched.update(positions)
+        return matches
+
+    def clear_txn_postings(self, txn_postings, link_name=None):
+        # Link the transactions and tag them as cleared
+        if link_name is None:
+            link_name = '{}-{}'.format(self.cleared_link_prefix,
+                                       next(self.link_count))
+        for txn_posting in txn_postings:
+            txn = txn_posting.txn
+            self.outcomes[id(txn)] = link_name
+            self.rewriter.add_tags(txn, self.cleared_tag_name)
+            self.rewriter.add_links(txn, link_name)
+
+    def mark_pending(self, txn_posting):
+        txn = txn_posting.txn
+        self.outcomes[id(txn)] = None
+        if self.flag_pending:
+            self.rewriter.set_flag(txn, flags.FLAG_WARNING)
+        self.rewriter.add_tags(txn, self.pending_tag_name)
 
     def max_matching_date(self, txn):
         if self.skip_weekends:
-            return dates.add_biz_days(txn.date, self.max_delta_days)
+            return self.add_biz_days(txn.date, self.max_delta_days)
         return txn.date + datetime.timedelta(days=self.max_delta_days)
 
-    def match_txn_postings(self, txn_posting, txn_posting2):
-        # We already know the two transactions are within the max time gap
-        # and share a clearing account
+    def count_main_account_postings(self, txn_posting):
+        # Count the postings of the transaction to the main account related
+        # to the clearing account of the given posting
+        main_account = self.clearing_accounts[txn_posting.posting.account]
+        return len([posting for posting in txn_posting.txn.postings
+                    if posting.account == main_account])
 
-        # We can have a match only if the postings to the clearing account
-        # on the two transactions balance out to 0
-        if txn_posting.posting.units != -txn_posting2.posting.units:
-            return False
 
-        # We can have a match only if one and only one of the two transactions
-        # has a posting to the main account related to their common clearing
-        # account
-        main_account = self.clearing_accounts[txn_posting.posting.account]
-        num_main_account_postings = len(
-            [posting for posting in (txn_posting.txn.postings + txn_posting2.txn.postings) if posting.account == main_account])
-        return num_main_account_postings == 1
+def txn_keys(txn_postings):
+    """Compute stable keys identifying transactions across ledger loads.
+
+    A key only depends on the date, payee, narration, and postings of a
+    transaction, so it survives edits elsewhere in the ledger but not edits
+    changing what the transaction can be paired with; identical transactions
+    are told apart by their order.
+
+    Args:
+      txn_postings: A list of TxnPosting objects in ascending chronological
+        order.
+    Returns:
+      A list of strings, the keys of the transactions.
+    """
+    keys = []
+    counts = collections.Counter()
+    for txn_posting in txn_postings:
+        txn = txn_posting.txn
+        postings = sorted('{} {}'.format(posting.account, posting.units)
+                          for posting in txn.postings)
+        digest = hashlib.sha1('\0'.join([
+            txn.date.isoformat(), txn.payee or '', txn.narration or '',
+            str(txn_posting.posting.units)] + postings).encode('utf-8')).hexdigest()[:16]
+        keys.append('{}-{}'.format(digest, counts[digest]))
+        counts[digest] += 1
+    return keys
+
+
+def link_numbers(link_names):
+    """Extract the numbers of cleared links.
+
+    Args:
+      link_names: An iterable of link names, each made of a prefix and a
+        number separated by a dash.
+    Returns:
+      A generator of the numbers of the links, as ints.
+
+    Example:
+      >>> list(link_numbers(['cleared-2', 'my-cleared-10']))
+      [2, 10]
+
+    """
+    return (int(link_name.rsplit('-', 1)[1]) for link_name in link_names)
+
+
+def align(group, reds, blues):
+    """Find an optimal order-preserving matching of red and blue transactions.
+
+    Args:
+      group: A Group object.
+      reds: A list of positions of red transactions, in ascending order.
+      blues: A list of positions of blue transactions, in ascending order.
+    Returns:
+      A list of pairs of positions of a red and a blue transaction; the pairs
+      maximize the number of matches and then minimize the total time gap.
+    """
+    blue_dates = [group.dates[position] for position in blues]
+    blue_max_dates = [group.max_dates[position] for position in blues]
+
+    # row[j] is the best (number of matches, minus total gap) matching the
+    # reds seen so far with the first j blues; bands[i] is the range of
+    # blues [lo, hi] (1-based) red i can be matched to. Outside of its band,
+    # a row is implicitly extended: to the left, with the values of the
+    # previous row; to the right, with its value at hi. Since the bands move
+    # forward with the reds, each row only costs the width of its band.
+    row = [(0, 0)] * (len(blues) + 1)
+    prev_hi = len(blues)
+    bands = [None]
+    choices = [None]
+    for red in reds:
+        date, max_date = group.dates[red], group.max_dates[red]
+        # A blue transaction matches if the later of the two falls within
+        # the time window of the earlier one
+        lo = bisect.bisect_left(blue_max_dates, date) + 1
+        hi = bisect.bisect_right(blue_dates, max_date)
+        bands.append((lo, hi))
+        band_choices = []
+        choices.append(band_choices)
+        if hi < lo:
+            continue
+
+        # Materialize the extension of the previous row up to this band
+        row[prev_hi + 1:hi + 1] = [row[prev_hi]] * max(0, hi - prev_hi)
+        diag = left = row[lo - 1]
+        for j in range(lo, hi + 1):
+            up = row[j]
+            best, choice = up, SKIP_RED
+            if left > best:
+                best, choice = left, SKIP_BLUE
+            gap = abs((blue_dates[j - 1] - date).days)
+            match = (diag[0] + 1, diag[1] - gap)
+            if match > best:
+                best, choice = match, MATCH
+            band_choices.append(choice)
+            diag = up
+            row[j] = left = best
+        prev_hi = hi
+
+    # Trace the choices back from the last red and blue transactions
+    pairs = []
+    i, j = len(reds), len(blues)
+    while i > 0 and j > 0:
+        lo, hi = bands[i]
+        if j > hi:
+            j = hi
+        elif j < lo:
+            i -= 1
+        else:
+            choice = choices[i][j - lo]
+            if choice == MATCH:
+                pairs.append((reds[i - 1], blues[j - 1]))
+                i, j = i - 1, j - 1
+            elif choice == SKIP_RED:
+                i -= 1
+            else:
+                j -= 1
+    return pairs
+
+
+def find_subset(amounts, target, max_size):
+    """Find a smallest subset of at least two amounts adding up to a target.
+
+    The search is bounded by the size of the subset and pruned as soon as the
+    largest amounts still available cannot reach the target anymore.
+
+    Args:
+      amounts: A list of positive beancount.core.number.Decimal objects in
+        descending order.
+      target: A positive beancount.core.number.Decimal object.
+      max_size: An int, the maximum size of the subset.
+    Returns:
+      A list of indexes into amounts, in ascending order, or None if there is
+      no such subset.
+
+    Example:
+      >>> find_subset([5, 4, 3, 1], 7, 3)
+      [1, 2]
+      >>> find_subset([5, 4, 3, 1], 2, 3) is None
+      True
+
+    """
+    # The sum of the largest amounts from any index on
+    sums = [0] + list(itertools.accumulate(amounts))
+
+    def search(start, remaining, size):
+        if size == 0:
+            return [] if remaining == 0 else None
+        for index in range(start, len(amounts) - size + 1):
+            if sums[index + size] - sums[index] < remaining:
+                # The remaining amounts are even smaller
+                break
+            amount = amounts[index]
+            if amount > remaining or (index > start and amount == amounts[index - 1]):
+                continue
+            subset = search(index + 1, remaining - amount, size - 1)
+            if subset is not None:
+                return [index] + subset
+        return None
+
+    for size in range(2, max_size + 1):
+        subset = search(0, target, size)
+        if subset is not None:
+            return subset
+    return None
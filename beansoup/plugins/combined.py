@@ -0,0 +1,144 @@
+"""A plugin running deposit_in_transit and clear_transactions together.
+
+It is equivalent to running the deposit_in_transit plugin followed by the
+clear_transactions plugin, but it scans the entries only once, dispatching
+each transaction to the plugin processing it, and builds the resulting list
+of entries in a single merge.
+
+The configuration string holds the configurations of both plugins, each
+introduced by the name of the plugin followed by a colon, e.g.:
+
+  plugin "beansoup.plugins.combined" "
+    deposit_in_transit: --auto_open --same_day_merge
+    clear_transactions: Assets:Clearing:Checking,Assets:Checking"
+
+Either configuration can be omitted to only run the other plugin.
+"""
+
+import collections
+
+from beancount.core import data
+
+from beansoup.plugins import clear_transactions
+from beansoup.plugins import config
+from beansoup.plugins import deposit_in_transit
+
+__plugins__ = ('plugin',)
+
+
+# The names of the plugins that can be combined, in the order they run.
+PLUGIN_NAMES = ('deposit_in_transit', 'clear_transactions')
+
+
+def plugin(entries, options_map, config_string):
+    try:
+        config_strings = split_config(config_string, options_map['filename'])
+    except config.ParseError as error:
+        return entries, [error]
+
+    errors = []
+
+    # Parse the configurations; a plugin with an invalid configuration is
+    # skipped, like it would be if it ran on its own
+    dit_args = None
+    if 'deposit_in_transit' in config_strings:
+        try:
+            _, dit_args = config.parse_args(deposit_in_transit.create_parser,
+                                            options_map['filename'],
+                                            config_strings['deposit_in_transit'])
+        except config.ParseError as error:
+            errors.append(error)
+        else:
+            if deposit_in_transit.is_disabled(dit_args):
+                dit_args = None
+
+    clear_args = None
+    if 'clear_transactions' in config_strings:
+        try:
+            clear_parser, clear_args = clear_transactions.parse_config(
+                config_strings['clear_transactions'], options_map)
+        except config.ParseError as error:
+            errors.append(error)
+
+    # Each plugin makes a single pass over the entries on its own
+    if not clear_args:
+        if not dit_args:
+            return entries, errors
+        new_entries, dit_errors = deposit_in_transit.plugin(
+            entries, options_map, config_strings['deposit_in_transit'])
+        return new_entries, errors + dit_errors
+    if not dit_args:
+        new_entries, clearing_errors = clear_transactions.clear_transactions(
+            entries, options_map, config_strings['clear_transactions'])
+        return new_entries, errors + clearing_errors
+
+    # Classify the entries in a single pass
+    splitter = deposit_in_transit.EntrySplitter(dit_args.dit_component, dit_args.ignored_tag)
+    processor = clear_transactions.Processor(clear_args)
+    groups = collections.defaultdict(list)
+    unchanged_entries = []
+    for entry in entries:
+        if not splitter.add(entry):
+            processor.add_entry(groups, len(unchanged_entries), entry)
+            unchanged_entries.append(entry)
+    errors.extend(splitter.errors)
+
+    new_entries, pairing_errors = deposit_in_transit.process_dits(
+        splitter.dits, splitter.open_entries(), dit_args)
+    errors.extend(pairing_errors)
+
+    # The transactions replacing the DIT ones may need clearing too; they are
+    # numbered after the unchanged entries
+    for index, entry in enumerate(new_entries, start=len(unchanged_entries)):
+        processor.add_entry(groups, index, entry)
+    try:
+        clear_transactions.check_accounts(clear_parser, clear_args, splitter.accounts_first)
+    except config.ParseError as error:
+        errors.append(error)
+    else:
+        modified_entries, clearing_errors = processor.clear_transactions(groups)
+        errors.extend(clearing_errors)
+        for index, entry in modified_entries.items():
+            if index < len(unchanged_entries):
+                unchanged_entries[index] = entry
+            else:
+                new_entries[index - len(unchanged_entries)] = entry
+
+    return deposit_in_transit.merge_entries(unchanged_entries, new_entries), errors
+
+
+def split_config(config_string, entries_filename):
+    """Split the configuration string into the configurations of the plugins.
+
+    Args:
+      config_string: A string, the configuration of the combined plugin.
+      entries_filename: A string, the name of the ledger file.
+    Returns:
+      A dict mapping the names of the configured plugins to their
+      configuration strings.
+    Raises:
+      beansoup.plugins.config.ParseError: If the configuration string does
+        not start with the name of a plugin or names a plugin twice.
+
+    Example:
+      >>> sorted(split_config('clear_transactions: --max_days 3 A,B', '').items())
+      [('clear_transactions', '--max_days 3 A,B')]
+
+    """
+    source = data.new_metadata(entries_filename, 0)
+    config_strings = {}
+    name = None
+    for token in (config_string or '').split():
+        if token.endswith(':') and token[:-1] in PLUGIN_NAMES:
+            name = token[:-1]
+            if name in config_strings:
+                raise config.ParseError(
+                    source, "plugin '{}' is configured more than once".format(name))
+            config_strings[name] = []
+        elif name is None:
+            raise config.ParseError(
+                source, "expecting one of {} before '{}'".format(
+                    ', '.join('{}:'.format(name) for name in PLUGIN_NAMES), token))
+        else:
+            config_strings[name].append(token)
+    return {name: ' '.join(tokens) for name, tokens in config_strings.items()}
@@ -2,6 +2,7 @@
 """
 
 import argparse
+import functools
 import re
 
 from beancount.core import data
@@ -28,6 +29,41 @@ class ArgumentParser(argparse.ArgumentParser):
         self.error(message)
 
 
+def parse_args(create_parser, entries_filename, config_string):
+    """Parse a plugin configuration string, reusing earlier results.
+
+    Plugins are run again each time a ledger is reloaded, usually with the
+    same configuration; building their parser and parsing their
+    configuration is only done once for each plugin, ledger file, and
+    configuration string. Validations depending on the entries must be
+    done separately.
+
+    Args:
+      create_parser: A function taking the name of the ledger file and
+        returning the ArgumentParser of a plugin.
+      entries_filename: A string, the name of the ledger file.
+      config_string: A string, the configuration of the plugin, or None.
+    Returns:
+      A pair of the ArgumentParser object and a new argparse.Namespace object
+      holding the parsed configuration; the caller is free to modify it.
+    Raises:
+      ParseError: If the configuration string is invalid.
+    """
+    parser, args, error = _parse_args(create_parser, entries_filename, config_string or '')
+    if error is not None:
+        raise ParseError(error.source, error.message)
+    return parser, argparse.Namespace(**vars(args))
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_args(create_parser, entries_filename, config_string):
+    parser = create_parser(entries_filename)
+    try:
+        return parser, parser.parse_args(config_string.split()), None
+    except ParseError as error:
+        return parser, None, error
+
+
 def re_type(string):
     """Argument type for regular expressions.
 
@@ -9,7 +9,7 @@ usage: beansoup.plugins.deposit_in_transit [--dit_component NAME]
                                            [--pending_tag TAG]
                                            [--ignored_tag TAG]
                                            [--link_prefix PREFIX]
-                                           [--skip_re REGEX]
+                                           [--max_days N] [--skip_re REGEX]
 
 optional arguments:
   --dit_component NAME  use NAME as the component name distinguishing deposit-
@@ -26,22 +26,24 @@ optional arguments:
   --ignored_tag TAG     ignore transactions that have a TAG tag (default:
                         IGNORED)
   --link_prefix PREFIX  link pairs of cleared transactions with PREFIX string
-                        followed by increasing count; otherwise it uses UUIDs
-                        (default: None)
+                        followed by increasing count; otherwise it uses hashes
+                        of the linked transactions (default: None)
+  --max_days N          only pair transactions if they occurred no more than N
+                        days apart (default: None)
   --skip_re REGEX       disable plugin if REGEX matches any sys.argv (default:
                         None)
 """
 
 import argparse
+import bisect
 import collections
 import itertools
 import sys
 
 from beancount.core import data, flags, getters
-from beancount.core.account import has_component
 
 from beansoup.plugins import config
-from beansoup.utils import links
+from beansoup.utils import accounts, links, rewrites
 
 __plugins__ = ('plugin',)
 
@@ -51,12 +53,38 @@ DITError = collections.namedtuple('DITError', 'source message entry')
 
 def plugin(entries, options_map, config_string):
     # Parse plugin config; report errors if any
+    try:
+        _, args = config.parse_args(create_parser, options_map['filename'], config_string)
+    except config.ParseError as error:
+        return entries, [error]
+
+    # If the plugin was called with the --skip_re option and the given
+    # regular expression matches any of the arguments in sys.argv,
+    # do not run the plugin and return the original entries instead.
+    if is_disabled(args):
+        return entries, []
+
+    unchanged_entries, new_entries, errors = process_entries(entries, args)
+
+    # FIXME: Consider printing the pending entries. Maybe return errors for them.
+
+    return merge_entries(unchanged_entries, new_entries), errors
+
+
+def create_parser(entries_filename):
+    """Create the parser of the configuration of the plugin.
+
+    Args:
+      entries_filename: A string, the name of the ledger file.
+    Returns:
+      A beansoup.plugins.config.ArgumentParser object.
+    """
     parser = config.ArgumentParser(
         prog=__name__,
         description='A plugin that automatically ties split deposit-in-transit transactions.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         add_help=False,
-        entries_filename=options_map['filename'])
+        entries_filename=entries_filename)
     parser.add_argument(
         '--dit_component', metavar='NAME', default='DIT',
         help='use %(metavar)s as the component name distinguishing deposit-in-transit accounts')
@@ -80,140 +108,302 @@ def plugin(entries, options_map, config_string):
         help='ignore transactions that have a %(metavar)s tag')
     parser.add_argument(
         '--link_prefix', metavar='PREFIX', default=None,
-        help='link pairs of cleared transactions with %(metavar)s string followed by increasing count; otherwise it uses UUIDs')
+        help='link pairs of cleared transactions with %(metavar)s string followed by increasing count; otherwise it uses hashes of the linked transactions')
+    parser.add_argument(
+        '--max_days', metavar='N', type=int, default=None,
+        help='only pair transactions if they occurred no more than %(metavar)s days apart')
     parser.add_argument(
         '--skip_re', metavar='REGEX', default=None, type=config.re_type,
         help='disable plugin if %(metavar)s matches any sys.argv')
 
-    try:
-        args = parser.parse_args((config_string or '').split())
-    except config.ParseError as error:
-        return entries, [error]
+    return parser
 
-    # If the plugin was called with the --skip_re option and the given
-    # regular expression matches any of the arguments in sys.argv,
-    # do not run the plugin and return the original entries instead.
-    if args.skip_re and any(args.skip_re.match(arg) for arg in sys.argv):
-        return entries, []
 
-    unchanged_entries, new_entries, errors = process_entries(entries, args)
+def is_disabled(args):
+    """Check whether the --skip_re option matches any of the arguments in sys.argv."""
+    return bool(args.skip_re and any(args.skip_re.match(arg) for arg in sys.argv))
 
-    # FIXME: Consider printing the pending entries. Maybe return errors for them.
 
-    return sorted(unchanged_entries + new_entries, key=data.entry_sortkey), errors
+def merge_entries(entries, new_entries):
+    """Merge new entries into a list of entries.
 
+    The entries are usually already sorted, so only the new ones are sorted
+    and inserted at their place, in O(n + k log n) time for k new entries.
 
-def process_entries(entries, args):
-    new_entries = []
+    Args:
+      entries: A list of directives, usually sorted.
+      new_entries: A list of directives, in any order.
+    Returns:
+      The same list of directives as sorted(entries + new_entries,
+      key=data.entry_sortkey).
+    """
+    sortkeys = [data.entry_sortkey(entry) for entry in entries]
+    if any(sortkey > next_sortkey
+           for sortkey, next_sortkey in zip(sortkeys, itertools.islice(sortkeys, 1, None))):
+        # Another plugin left the entries out of order
+        return sorted(entries + new_entries, key=data.entry_sortkey)
+
+    merged_entries = []
+    start = 0
+    for entry in sorted(new_entries, key=data.entry_sortkey):
+        # New entries go after existing ones with the same sort key
+        index = bisect.bisect_right(sortkeys, data.entry_sortkey(entry), lo=start)
+        merged_entries.extend(entries[start:index])
+        merged_entries.append(entry)
+        start = index
+    merged_entries.extend(entries[start:])
+    return merged_entries
 
-    if args.auto_open:
-        new_entries.extend(open_dit_accounts(entries, args.dit_component))
 
+def process_entries(entries, args):
     # Find all DIT transactions to be processed; their original entries
     # will be replaced by new ones
-    dits, unchanged_entries, errors = split_entries(
+    dits, unchanged_entries, open_entries, errors = split_entries(
         entries,
         dit_component=args.dit_component,
         ignored_tag=args.ignored_tag)
 
-    pairs, singletons, pairing_errors = pair_dits(
-        dits, dit_component=args.dit_component)
+    new_entries, pairing_errors = process_dits(dits, open_entries, args)
     errors.extend(pairing_errors)
 
-    cleared_links = links.count(args.link_prefix)
+    return unchanged_entries, new_entries, errors
+
+
+def process_dits(dits, open_entries, args):
+    """Pair the DIT transactions and replace them with new entries.
+
+    Args:
+      dits: A list of DIT postings (as TxnPosting objects).
+      open_entries: A list of Open directives for the DIT accounts that are
+        not opened; they are only used with the --auto_open option.
+      args: An argparse.Namespace object, the configuration of the plugin.
+    Returns:
+      A pair of a list of new entries and a list of errors.
+    """
+    new_entries = []
+
+    if args.auto_open:
+        new_entries.extend(open_entries)
+
+    pairs, singletons, errors = pair_dits(
+        dits, dit_component=args.dit_component, max_days=args.max_days)
+
+    # Without a prefix, links are digests of the linked transactions
+    cleared_links = links.count(args.link_prefix) if args.link_prefix else None
+    # Most entries end up with the same tags, which are shared among them
+    rewriter = rewrites.EntryRewriter()
     for pair in pairs:
         new_entries.extend(process_pair(
             pair,
             cleared_tag=args.cleared_tag,
             cleared_links=cleared_links,
-            same_day_merge=args.same_day_merge))
+            same_day_merge=args.same_day_merge,
+            rewriter=rewriter))
 
     new_entries.extend(
         [process_singleton(singleton,
                            flag_pending=args.flag_pending,
-                           pending_tag=args.pending_tag) for singleton in singletons])
+                           pending_tag=args.pending_tag,
+                           rewriter=rewriter) for singleton in singletons])
 
-    return unchanged_entries, new_entries, errors
+    return new_entries, errors
 
 
-def open_dit_accounts(entries, dit_component):
+def open_dit_accounts(accounts_first, opened_accounts, is_dit_account):
     """
     Minimally adapted from beancount.plugins.auto_accounts.
-    """
-    opened_accounts = {entry.account
-                       for entry in entries
-                       if isinstance(entry, data.Open)}
 
+    Args:
+      accounts_first: A dict mapping the names of all the accounts used by
+        the entries to the date they are first used.
+      opened_accounts: A set of the names of the accounts already opened.
+      is_dit_account: A map from account names to whether they are DIT
+        accounts, as returned by beansoup.utils.accounts.has_component_map().
+    Returns:
+      A list of Open directives for the DIT accounts that are not opened.
+    """
     new_entries = []
-    accounts_first, _ = getters.get_accounts_use_map(entries)
-    for index, (account, date_first_used) in enumerate(sorted(accounts_first.items())):
-        if ((account not in opened_accounts) and
-                has_component(account, dit_component)):
+    for index, (account_name, date_first_used) in enumerate(sorted(accounts_first.items())):
+        if (account_name not in opened_accounts) and is_dit_account[account_name]:
             meta = data.new_metadata(__name__, index)
-            new_entry = data.Open(meta, date_first_used, account, None, None)
+            new_entry = data.Open(meta, date_first_used, account_name, None, None)
             new_entries.append(new_entry)
 
     return new_entries
 
 
 def split_entries(entries, dit_component, ignored_tag):
-    dits, unchanged_entries, errors = [], [], []
-    for entry in entries:
-        if (isinstance(entry, data.Transaction) and
-            not (entry.tags and ignored_tag in entry.tags)):
-            dit_postings = [posting for posting in entry.postings if has_component(posting.account, dit_component)]
-            num_dit_postings = len(dit_postings)
-        else:
-            num_dit_postings = 0
-        if num_dit_postings == 0:
-            unchanged_entries.append(entry)
+    """Split the DIT transactions from the other entries.
+
+    The accounts used by the entries are gathered in the same pass, to open
+    the DIT accounts that need to be.
+
+    Returns:
+      A tuple of a list of DIT postings (as TxnPosting objects), a list of
+      the other entries, a list of Open directives for the DIT accounts
+      that are not opened, and a list of errors.
+    """
+    splitter = EntrySplitter(dit_component, ignored_tag)
+    unchanged_entries = [entry for entry in entries if not splitter.add(entry)]
+    return splitter.dits, unchanged_entries, splitter.open_entries(), splitter.errors
+
+
+class EntrySplitter:
+    """Sort out the DIT transactions, one entry at a time.
+
+    Attributes:
+      dits: A list of the DIT postings (as TxnPosting objects) found so far.
+      errors: A list of errors.
+      accounts_first: A dict mapping the names of all the accounts used by
+        the entries so far to the date they are first used.
+      opened_accounts: A set of the names of the accounts opened so far.
+      is_dit_account: A map from account names to whether they are DIT
+        accounts.
+    """
+
+    def __init__(self, dit_component, ignored_tag):
+        self.ignored_tag = ignored_tag
+        self.dits = []
+        self.errors = []
+        self.accounts_first = {}
+        self.opened_accounts = set()
+        self.is_dit_account = accounts.has_component_map(dit_component)
+
+    def add(self, entry):
+        """Add an entry.
+
+        Args:
+          entry: A directive.
+        Returns:
+          True if the entry is a DIT transaction to be processed.
+        """
+        accounts_first = self.accounts_first
+        dit_postings = []
+        if isinstance(entry, data.Transaction):
+            is_dit_account = self.is_dit_account
+            for posting in entry.postings:
+                account_name = posting.account
+                if account_name not in accounts_first:
+                    accounts_first[account_name] = entry.date
+                if is_dit_account[account_name]:
+                    dit_postings.append(posting)
+            if entry.tags and self.ignored_tag in entry.tags:
+                dit_postings = []
         else:
-            dits.append(data.TxnPosting(entry, dit_postings[0]))
-            if num_dit_postings > 1:
-                errors.append(DITError(
-                    entry.meta,
-                    "(deposit_in_transit) Found entry with multiple postings to DIT accounts; "
-                    "only processing posting to {} account".format(
-                        dit_postings[0].account),
-                    entry))
-    return dits, unchanged_entries, errors
-
-
-def pair_dits(dits, dit_component):
-    # A map from amounts to all DIT postings (as a TxnPosting) sharing
-    # that amount
-    units_map = collections.defaultdict(list)
+            if isinstance(entry, data.Open):
+                self.opened_accounts.add(entry.account)
+            for account_name in getters.get_entry_accounts(entry):
+                accounts_first.setdefault(account_name, entry.date)
+        if not dit_postings:
+            return False
+        self.dits.append(data.TxnPosting(entry, dit_postings[0]))
+        if len(dit_postings) > 1:
+            self.errors.append(DITError(
+                entry.meta,
+                "(deposit_in_transit) Found entry with multiple postings to DIT accounts; "
+                "only processing posting to {} account".format(
+                    dit_postings[0].account),
+                entry))
+        return True
+
+    def open_entries(self):
+        """Return Open directives for the DIT accounts that are not opened."""
+        return open_dit_accounts(self.accounts_first, self.opened_accounts,
+                                 self.is_dit_account)
+
+
+def pair_dits(dits, dit_component, max_days=None):
+    # A map from keys, as returned by dit_keys(), to all DIT postings (as a
+    # TxnPosting) sharing that key, in order; the postings already processed
+    # are only dropped once they reach the front, so that each removal is O(1)
+    dit_map = collections.defaultdict(collections.deque)
+    base_accounts = accounts.remove_component_map(dit_component)
     for dit in dits:
-        units_map[dit.posting.units].append(dit)
+        for key in dit_keys(dit, base_accounts):
+            dit_map[key].append(dit)
 
     pairs, singletons, errors = [], [], []
     skip_ids = set()
     for dit in dits:
         if id(dit.txn) in skip_ids:
             continue
-        units_map[dit.posting.units].remove(dit)
-        dit2 = match_dit(dit, units_map.get(-dit.posting.units), dit_component)
+        skip_ids.add(id(dit.txn))
+        dit2 = match_dit(dit, dit_map, skip_ids, base_accounts, max_days)
         if dit2:
             # Found matching DIT transaction
             pairs.append((dit, dit2))
-            skip_ids |= {id(dit2.txn)}
-            units_map[dit2.posting.units].remove(dit2)
+            skip_ids.add(id(dit2.txn))
         else:
             singletons.append(dit)
 
     return pairs, singletons, errors
 
 
-def match_dit(dit, candidate_dits, dit_component):
-    # FIXME: check DIT- and base-accounts match
-    return candidate_dits[0] if candidate_dits else None
+def dit_keys(dit, base_accounts):
+    """Return the keys a DIT posting can be matched by.
 
+    A DIT posting moving units from an account to the DIT account of another
+    one, say from Assets:Savings to Assets:DIT:Checking, can only be matched
+    by a DIT posting moving the opposite units the other way around, i.e.,
+    from Assets:Checking to Assets:DIT:Savings.
+
+    Args:
+      dit: A beancount.core.data.TxnPosting object, a DIT posting.
+      base_accounts: A map from DIT account names to the names of their base
+        accounts, as returned by beansoup.utils.accounts.remove_component_map().
+    Returns:
+      A set of tuples of the base account of the DIT account, the account of
+      another posting of the transaction, and the units of the DIT posting.
+    """
+    base_account = base_accounts[dit.posting.account]
+    return {(base_account, posting.account, dit.posting.units)
+            for posting in dit.txn.postings if posting is not dit.posting}
+
+
+def match_dit(dit, dit_map, skip_ids, base_accounts, max_days=None):
+    """Find the DIT posting matching a given one.
+
+    Args:
+      dit: A beancount.core.data.TxnPosting object, a DIT posting.
+      dit_map: A dict mapping keys, as returned by dit_keys(), to deques
+        of DIT postings in chronological order.
+      skip_ids: A set of the ids of the transactions already processed.
+      base_accounts: A map from DIT account names to the names of their base
+        accounts, as returned by beansoup.utils.accounts.remove_component_map().
+      max_days: An optional int, the maximum number of days between the
+        matching postings.
+    Returns:
+      The nearest unprocessed DIT posting matching the given one, or None.
+    """
+    base_account = base_accounts[dit.posting.account]
+    best_dit = None
+    for posting in dit.txn.postings:
+        if posting is dit.posting:
+            continue
+        candidate_dits = dit_map.get((posting.account, base_account, -dit.posting.units))
+        while candidate_dits and id(candidate_dits[0].txn) in skip_ids:
+            candidate_dits.popleft()
+        if not candidate_dits:
+            continue
+        # All the postings preceding dit have been processed already, so the
+        # nearest candidate is the one at the front
+        candidate_dit = candidate_dits[0]
+        if (max_days is not None and
+                abs((candidate_dit.txn.date - dit.txn.date).days) > max_days):
+            continue
+        if (best_dit is None or
+                data.entry_sortkey(candidate_dit.txn) < data.entry_sortkey(best_dit.txn)):
+            best_dit = candidate_dit
+    return best_dit
+
+
+def process_pair(pair, cleared_tag, cleared_links, same_day_merge, rewriter=None):
+    rewriter = rewriter or rewrites.EntryRewriter()
 
-def process_pair(pair, cleared_tag, cleared_links, same_day_merge):
     def tag_and_link(entry, cleared_link):
-        tags = (entry.tags or set()) | {cleared_tag}
-        links = (entry.links or set()) | {cleared_link}
-        return entry._replace(tags=tags, links=links)
+        rewriter.add_tags(entry, cleared_tag)
+        rewriter.add_links(entry, cleared_link)
+        return rewriter.rewrite(entry)
     
     def xform_posting(posting):
         return data.Posting(posting.account,
@@ -242,11 +432,10 @@ def process_pair(pair, cleared_tag, cleared_links, same_day_merge):
         # Merge the two transactions
         meta = pair[0].txn.meta
         flag = pair[0].txn.flag
-        tags = ((pair[0].txn.tags or set()) |
-                (pair[1].txn.tags or set()) |
-                {cleared_tag})
-        links = ((pair[0].txn.links or set()) |
-                 (pair[1].txn.links or set())) or data.EMPTY_SET
+        tags = rewriter.union(pair[0].txn.tags,
+                              (pair[1].txn.tags or set()) | {cleared_tag})
+        merged_links = rewriter.union(pair[0].txn.links,
+                                      pair[1].txn.links or ()) or data.EMPTY_SET
         postings = ([posting for posting in pair[0].txn.postings if posting is not pair[0].posting] +
                     [posting for posting in pair[1].txn.postings if posting is not pair[1].posting])
         new_entry = data.Transaction(
@@ -256,7 +445,7 @@ def process_pair(pair, cleared_tag, cleared_links, same_day_merge):
             payee,
             narration,
             tags,
-            links,
+            merged_links,
             postings)
         return (new_entry, )
 
@@ -265,15 +454,18 @@ def process_pair(pair, cleared_tag, cleared_links, same_day_merge):
     lineno = int((pair[0].txn.meta.get('lineno', 0) +
                   pair[1].txn.meta.get('lineno', 0)) / 2)
     meta = data.new_metadata(__name__, lineno)
-    cleared_link = next(cleared_links)
+    if cleared_links:
+        cleared_link = next(cleared_links)
+    else:
+        cleared_link = links.digest(pair[0].txn, pair[1].txn)
     new_entry = data.Transaction(
         meta,
         date,
         flags.FLAG_OKAY,
         payee,
         narration,
-        {cleared_tag},
-        {cleared_link},        
+        rewriter.intern((cleared_tag,)),
+        {cleared_link},
         [xform_posting(pair[0].posting), xform_posting(pair[1].posting)])
 
     return (tag_and_link(pair[0].txn, cleared_link),
@@ -295,8 +487,10 @@ def is_pair_mergeable(pair):
     return True
 
     
-def process_singleton(singleton, flag_pending, pending_tag):
+def process_singleton(singleton, flag_pending, pending_tag, rewriter=None):
+    rewriter = rewriter or rewrites.EntryRewriter()
     entry = singleton.txn
-    flag = flags.FLAG_WARNING if flag_pending else entry.flag
-    tags = (entry.tags or set()) | {pending_tag}
-    return entry._replace(flag=flag, tags=tags)
+    if flag_pending:
+        rewriter.set_flag(entry, flags.FLAG_WARNING)
+    rewriter.add_tags(entry, pending_tag)
+    return rewriter.rewrite(entry)
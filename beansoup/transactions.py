@@ -62,6 +62,7 @@ class TransactionCompleter:
         self.model_txns = [entry for entry in entries if is_model(entry)]
         self.account = account
         self.min_score = min_score
+        self.max_age = max_age
         self.interpolated = interpolated
 
     def __call__(self, entries):
@@ -83,6 +84,21 @@ class TransactionCompleter:
             self.complete_entry(entry)
         return entries
 
+    def stream_entries(self, entries):
+        """Complete the given entries, one at a time.
+
+        This is the streaming version of `complete_entries`; wrap it with
+        beansoup.importers.mixins.streaming to use it in a filter chain.
+
+        Args:
+          entries: An iterable of entries to be completed.
+        Yields:
+          The completed entries, in the same order.
+        """
+        for entry in entries:
+            self.complete_entry(entry)
+            yield entry
+
     def complete_entry(self, entry):
         """Complete the given entry.
 
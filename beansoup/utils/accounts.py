@@ -0,0 +1,62 @@
+"""Utilities for working with account names.
+
+Plugins often need to evaluate the same predicate on the account of every
+posting of a ledger, although a ledger only has a handful of distinct
+accounts. The maps defined here compute such predicates once per account
+name and then answer with a plain dict lookup.
+"""
+
+from beancount.core import account
+
+
+class AccountMap(dict):
+    """A dict computing the values of a function of account names on demand.
+
+    Example:
+      >>> is_dit = AccountMap(lambda name: 'DIT' in name.split(':'))
+      >>> is_dit['Assets:DIT:Checking'], is_dit['Assets:Checking']
+      (True, False)
+      >>> sorted(is_dit)
+      ['Assets:Checking', 'Assets:DIT:Checking']
+
+    """
+
+    def __init__(self, function):
+        """Create a new map.
+
+        Args:
+          function (Callable[[str], Any]): The function of account names
+            whose values are cached.
+        """
+        super().__init__()
+        self.function = function
+
+    def __missing__(self, account_name):
+        value = self[account_name] = self.function(account_name)
+        return value
+
+
+def has_component_map(component):
+    """A map from account names to whether they have a given component.
+
+    Args:
+      component (str): The name of a component, e.g., 'DIT'.
+
+    Returns:
+      AccountMap: A map of bools, like beancount.core.account.has_component.
+    """
+    return AccountMap(lambda account_name: account.has_component(account_name, component))
+
+
+def remove_component_map(component):
+    """A map from account names to the same names without a given component.
+
+    Args:
+      component (str): The name of a component, e.g., 'DIT'.
+
+    Returns:
+      AccountMap: A map of account names; e.g., with a 'DIT' component,
+        'Assets:DIT:Checking' maps to 'Assets:Checking'.
+    """
+    return AccountMap(lambda account_name: account.join(
+        *[name for name in account.split(account_name) if name != component]))
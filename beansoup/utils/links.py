@@ -1,5 +1,6 @@
 """Utilities for working with links."""
 
+import hashlib
 import uuid
 
 
@@ -23,3 +24,27 @@ def count(link_prefix=None, start=1):
     else:
         while True:
             yield str(uuid.uuid4())
+
+
+def digest(*entries):
+    """A link name derived from the identity of the entries it links.
+
+    Unlike UUIDs, it is the same every time a ledger is loaded, so that the
+    output of a plugin does not change from one load to the next.
+
+    Args:
+      *entries (beancount.core.data.Transaction): The entries to link; their
+        order matters.
+
+    Returns:
+      str: A link name made of 32 hexadecimal digits, computed from the
+        file name, line number, date, and posting amounts of the entries,
+        which are unique within a ledger.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for entry in entries:
+        hasher.update(repr((entry.meta.get('filename'),
+                            entry.meta.get('lineno'),
+                            entry.date.isoformat(),
+                            [str(posting.units) for posting in entry.postings])).encode('utf-8'))
+    return hasher.hexdigest()
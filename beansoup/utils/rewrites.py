@@ -0,0 +1,160 @@
+"""Utilities for rewriting entries.
+
+Plugins often tag, link, or flag a large share of the transactions of a
+ledger. Rewriting an entry with namedtuple._replace copies all its fields,
+and adding a tag builds a new set for every entry, although most entries
+end up with one of a handful of distinct sets of tags and links. The
+rewriter defined here accumulates the changes to each entry, applies them
+with a single _replace, and shares equal sets of tags and links among the
+rewritten entries.
+"""
+
+
+class Changes:
+    """The changes pending on an entry."""
+
+    __slots__ = ('entry', 'flag', 'tags', 'links')
+
+    def __init__(self, entry):
+        """Create the changes of an entry, initially none.
+
+        Args:
+          entry (beancount.core.data.Transaction): The original entry.
+        """
+        self.entry = entry
+        # The new flag of the entry, or None to keep its flag
+        self.flag = None
+        # The tags and links to add to the entry
+        self.tags = set()
+        self.links = set()
+
+
+class EntryRewriter:
+    """Accumulates changes to entries and applies them all at once.
+
+    Example:
+      >>> from beancount.core import data
+      >>> rewriter = EntryRewriter()
+      >>> entry = data.Transaction(data.new_metadata('test', 1), None, '*',
+      ...                          None, 'Deposit', None, None, [])
+      >>> rewriter.add_tags(entry, 'CLEARED')
+      >>> rewriter.add_links(entry, 'cleared-1')
+      >>> rewriter.set_flag(entry, '!')
+      >>> new_entry = rewriter.rewrite(entry)
+      >>> new_entry.flag, sorted(new_entry.tags), sorted(new_entry.links)
+      ('!', ['CLEARED'], ['cleared-1'])
+      >>> rewriter.rewrite(entry) is entry
+      True
+
+    """
+
+    def __init__(self):
+        """Create a new rewriter without pending changes."""
+        self.changes = {}
+        self.interned_sets = {}
+        self.unions = {}
+
+    def intern(self, names):
+        """Return the shared frozenset equal to a set of names.
+
+        Args:
+          names (Iterable[str]): Some tags or links.
+
+        Returns:
+          frozenset: A frozenset of the names, the same object for all
+            equal sets of names interned by this rewriter.
+        """
+        names = frozenset(names)
+        return self.interned_sets.setdefault(names, names)
+
+    def union(self, names, new_names):
+        """Return the shared frozenset of the union of two sets of names.
+
+        Args:
+          names (Optional[Set[str]]): The tags or links of an entry, if any.
+          new_names (Set[str]): The tags or links to add.
+
+        Returns:
+          frozenset: The interned union of the names.
+        """
+        key = (names or None, frozenset(new_names))
+        try:
+            return self.unions[key]
+        except KeyError:
+            union = self.unions[key] = self.intern(key[1].union(names or ()))
+            return union
+        except TypeError:
+            # A mutable set of names cannot be looked up
+            return self.intern(key[1].union(names))
+
+    def _changes(self, entry):
+        changes = self.changes.get(id(entry))
+        if changes is None:
+            changes = self.changes[id(entry)] = Changes(entry)
+        return changes
+
+    def add_tags(self, entry, *tags):
+        """Add tags to an entry when it is rewritten.
+
+        Args:
+          entry (beancount.core.data.Transaction): The entry to tag.
+          *tags (str): The tags to add.
+        """
+        self._changes(entry).tags.update(tags)
+
+    def add_links(self, entry, *links):
+        """Add links to an entry when it is rewritten.
+
+        Args:
+          entry (beancount.core.data.Transaction): The entry to link.
+          *links (str): The links to add.
+        """
+        self._changes(entry).links.update(links)
+
+    def set_flag(self, entry, flag):
+        """Change the flag of an entry when it is rewritten.
+
+        Args:
+          entry (beancount.core.data.Transaction): The entry to flag.
+          flag (str): The new flag.
+        """
+        self._changes(entry).flag = flag
+
+    def rewrite(self, entry):
+        """Apply the changes pending on an entry.
+
+        Args:
+          entry (beancount.core.data.Transaction): An entry.
+
+        Returns:
+          beancount.core.data.Transaction: The entry with its pending changes,
+            or the entry itself if there are none; the pending changes are
+            then discarded.
+        """
+        changes = self.changes.pop(id(entry), None)
+        if changes is None:
+            return entry
+        return self._apply(changes)
+
+    def rewrite_all(self):
+        """Apply the changes pending on all entries.
+
+        Yields:
+          Tuple[beancount.core.data.Transaction, beancount.core.data.Transaction]:
+            The pairs of original and rewritten entries, in the order the
+            entries were first changed; the pending changes are discarded.
+        """
+        changes, self.changes = self.changes, {}
+        for entry_changes in changes.values():
+            yield entry_changes.entry, self._apply(entry_changes)
+
+    def _apply(self, changes):
+        entry = changes.entry
+        fields = {}
+        if changes.flag is not None and changes.flag != entry.flag:
+            fields['flag'] = changes.flag
+        if changes.tags:
+            fields['tags'] = self.union(entry.tags, changes.tags)
+        if changes.links:
+            fields['links'] = self.union(entry.links, changes.links)
+        return entry._replace(**fields) if fields else entry
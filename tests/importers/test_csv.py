@@ -0,0 +1,228 @@
+"""Unit tests for beansoup.importers.csv module."""
+
+import datetime
+from os import path
+import pytest
+import tempfile
+import unittest
+
+from beancount.ingest import cache
+from beancount.parser import cmptest
+
+from beansoup.importers import csv
+from beansoup.importers import td
+from beansoup.utils import testing
+
+
+class TestIdentify(unittest.TestCase):
+
+    @testing.docfile(mode='w', suffix='.csv')
+    def test_header(self, filename):
+        """\
+        Date,Description,Withdrawals,Deposits,Balance
+        04/01/2016,12-345 Smith    RLS,404.38,,5194.21
+        """
+        file = cache.get_file(filename)
+        assert file.convert(csv.head_line) == 'Date,Description,Withdrawals,Deposits,Balance'
+
+        importer = td.Importer('Assets:TD:Checking',
+                               filename_regexp=path.basename(filename),
+                               header_regexp='^Date,Description,')
+        assert importer.identify(file)
+
+        importer = td.Importer('Assets:TD:Checking',
+                               filename_regexp=path.basename(filename),
+                               header_regexp='^Date,Amount$')
+        assert not importer.identify(file)
+
+    @testing.docfile(mode='w', suffix='.csv')
+    def test_filename(self, filename):
+        """\
+        04/01/2016,12-345 Smith    RLS,404.38,,5194.21
+        """
+        file = cache.get_file(filename)
+
+        importer = td.Importer('Assets:TD:Checking',
+                               filename_regexp=path.basename(filename))
+        assert importer.identify(file)
+
+        importer = td.Importer('Assets:TD:Checking',
+                               filename_regexp='no-match.csv',
+                               header_regexp='^04/01/2016,')
+        assert not importer.identify(file)
+
+
+iter_lines_data = [
+    (b'', []),
+    (b'a,b\n', ['a,b\n']),
+    (b'a,b\r\nc,d', ['a,b\r\n', 'c,d']),
+    ('été,1\nnoël,2\n'.encode('utf-8'), ['été,1\n', 'noël,2\n']),
+]
+
+@pytest.mark.parametrize('contents,expected', iter_lines_data)
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 1024])
+def test_iter_lines(contents, expected, chunk_size):
+    with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+        f.write(contents)
+        f.flush()
+        assert list(csv.iter_lines(f.name, chunk_size=chunk_size)) == expected
+
+
+class TestParse(unittest.TestCase):
+
+    @testing.docfile(mode='w', suffix='.csv')
+    def test_use_mmap(self, filename):
+        """\
+        04/01/2016,12-345 Smith    RLS,404.38,,5194.21
+        04/05/2016,"COSTCO
+        #9876543",60.24,,5133.97
+        04/29/2016,CANADA           RIT,,345.24,5479.21
+        """
+        file = cache.get_file(filename)
+        importer = td.Importer('Assets:TD:Checking',
+                               filename_regexp=path.basename(filename))
+        rows = importer.parse(file)
+        assert len(rows) == 3
+        assert rows[1].description == 'COSTCO\n#9876543'
+
+        importer = td.Importer('Assets:TD:Checking',
+                               filename_regexp=path.basename(filename),
+                               use_mmap=True)
+        assert importer.parse(file) == rows
+
+
+guess_encoding_data = [
+    (b'Date,Amount', 'utf-8'),
+    ('Noël,€'.encode('utf-8')[:-1], 'utf-8'),
+    ('Noël'.encode('utf-8-sig'), 'utf-8-sig'),
+    ('Noël'.encode('utf-16'), 'utf-16'),
+    ('Noël'.encode('utf-32'), 'utf-32'),
+    ('Noël,€'.encode('cp1252'), 'cp1252'),
+    (b'No\xebl,\x81', 'latin-1'),
+]
+
+@pytest.mark.parametrize('head,expected', guess_encoding_data)
+def test_guess_encoding(head, expected):
+    assert csv.guess_encoding(head) == expected
+
+
+encoded_contents_data = [
+    ('utf-8', False),
+    ('utf-8-sig', False),
+    ('utf-8-sig', True),
+    ('utf-16', False),
+    ('utf-16', True),
+    ('latin-1', False),
+    ('latin-1', True),
+]
+
+@pytest.mark.parametrize('encoding,use_mmap', encoded_contents_data)
+def test_parse_encoding(encoding, use_mmap):
+    text = ('Date,Description,Withdrawals,Deposits,Balance\n'
+            '04/01/2016,CAFÉ DU MONDE,4.50,,100.00\n')
+    with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+        f.write(text.encode(encoding))
+        f.flush()
+        file = cache.get_file(f.name)
+        importer = td.Importer('Assets:TD:Checking',
+                               filename_regexp=path.basename(f.name),
+                               header_regexp='^Date,',
+                               use_mmap=use_mmap)
+        assert importer.identify(file)
+        rows = csv.parse(file, 'tdcanadatrust',
+                         lambda row, lineno: row, use_mmap=use_mmap)
+        assert rows[1][1] == 'CAFÉ DU MONDE'
+
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_parse_encoding_beyond_head(use_mmap, monkeypatch):
+    # The head of the file used to guess its encoding is plain ASCII
+    monkeypatch.setattr(csv, 'ENCODING_DETECT_MAX_BYTES', 64)
+    text = ('Date,Description,Withdrawals,Deposits,Balance\n'
+            '04/01/2016,RLS,404.38,,5194.21\n'
+            '04/02/2016,CAFÉ DU MONDE,4.50,,5189.71\n')
+    with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+        f.write(text.encode('latin-1'))
+        f.flush()
+        file = cache.get_file(f.name)
+        rows = csv.parse(file, 'tdcanadatrust',
+                         lambda row, lineno: row, use_mmap=use_mmap)
+        assert rows[2][1] == 'CAFÉ DU MONDE'
+
+
+@pytest.mark.parametrize('encoding,num_passes', [('utf-8', 1), ('latin-1', 2)])
+def test_parse_mmap_passes(encoding, num_passes, monkeypatch):
+    # A second pass over the file is only made if the guessed encoding fails
+    monkeypatch.setattr(csv, 'ENCODING_DETECT_MAX_BYTES', 64)
+    iter_chunks = csv.iter_chunks
+    passes = []
+
+    def counting_iter_chunks(*args, **kwargs):
+        passes.append(kwargs.get('encoding'))
+        return iter_chunks(*args, **kwargs)
+    monkeypatch.setattr(csv, 'iter_chunks', counting_iter_chunks)
+
+    text = ('Date,Description,Withdrawals,Deposits,Balance\n'
+            '04/01/2016,RLS,404.38,,5194.21\n'
+            '04/02/2016,CAFÉ DU MONDE,4.50,,5189.71\n')
+    with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+        f.write(text.encode(encoding))
+        f.flush()
+        rows = csv.parse(cache.get_file(f.name), 'tdcanadatrust',
+                         lambda row, lineno: row, use_mmap=True)
+        assert rows[2][1] == 'CAFÉ DU MONDE'
+        assert len(passes) == num_passes
+
+
+balance_dates_data = [
+    ('daily', 1, datetime.date(2016, 4, 29), datetime.date(2016, 5, 1),
+     ['2016-04-30', '2016-05-01', '2016-05-02']),
+    ('weekly', 1, datetime.date(2016, 4, 29), datetime.date(2016, 5, 9),
+     ['2016-05-02', '2016-05-09', '2016-05-16']),
+    ('monthly', 1, datetime.date(2016, 1, 31), datetime.date(2016, 4, 1),
+     ['2016-02-01', '2016-03-01', '2016-04-01', '2016-05-01']),
+    ('monthly', 4, datetime.date(2015, 12, 6), datetime.date(2015, 12, 16),
+     ['2016-01-04']),
+]
+
+@pytest.mark.parametrize('cadence,first_day,start_date,end_date,expected',
+                         balance_dates_data)
+def test_balance_dates(cadence, first_day, start_date, end_date, expected):
+    dates = csv.balance_dates(start_date, end_date, cadence, first_day=first_day)
+    assert [date.isoformat() for date in dates] == expected
+
+
+class TestBalanceCadence(cmptest.TestCase):
+
+    @testing.docfile(mode='w', suffix='.csv')
+    def test_weekly(self, filename):
+        """\
+        04/01/2016,12-345 Smith    RLS,404.38,,5194.21
+        04/05/2016,COSTCO #9876543,60.24,,5133.97
+        04/05/2016,METRO ETS 2020,34.90,,5099.07
+        04/20/2016,CANADA           RIT,,345.24,5444.31
+        """
+        file = cache.get_file(filename)
+        importer = td.Importer('Assets:TD:Checking', 'CAD',
+                               filename_regexp=path.basename(filename),
+                               balance_cadence='weekly')
+        entries = importer.extract(file)
+        self.assertEqualEntries("""
+        2016-04-01 * "12-345 Smith    RLS"
+          Assets:TD:Checking  -404.38 CAD
+
+        2016-04-05 * "COSTCO #9876543"
+          Assets:TD:Checking  -60.24 CAD
+
+        2016-04-05 * "METRO ETS 2020"
+          Assets:TD:Checking  -34.90 CAD
+
+        2016-04-20 * "CANADA           RIT"
+          Assets:TD:Checking  345.24 CAD
+
+        2016-04-04 balance Assets:TD:Checking   5194.21 CAD
+        2016-04-11 balance Assets:TD:Checking   5099.07 CAD
+        2016-04-18 balance Assets:TD:Checking   5099.07 CAD
+        2016-04-25 balance Assets:TD:Checking   5444.31 CAD
+        """, entries)
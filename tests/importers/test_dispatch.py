@@ -0,0 +1,111 @@
+"""Unit tests for beansoup.importers.dispatch module."""
+
+import datetime
+import pytest
+from os import path
+import tempfile
+
+from beancount.ingest import cache
+
+from beansoup.importers import amex
+from beansoup.importers import dispatch
+from beansoup.importers import filing
+from beansoup.utils import testing
+
+
+DATADIR = tempfile.gettempdir()
+
+
+def make_importer():
+    return dispatch.Importer([
+        filing.Importer('Assets:Checking', basename='checking',
+                        filename_regexp=r'^checking_(?P<year>\d{4})-(?P<month>\d{2})\.pdf$'),
+        filing.Importer('Assets:Savings', first_day=15,
+                        filename_regexp=r'^savings_(?P<year>\d{4})-(?P<month>\d{2})\.pdf$'),
+        amex.PdfFilingImporter('Liabilities:Amex', first_day=28),
+        filing.Importer('Assets:Other',
+                        filename_regexp=r'(?i)^OTHER_(?P<year>\d{4})_(?P<month>\w{3})\.pdf$'),
+        testing.ConstImporter([], 'Assets:Fallback'),
+    ])
+
+
+dispatch_data = [
+    ('checking_2016-05.pdf', 'Assets:Checking', datetime.date(2016, 5, 31)),
+    ('savings_2016-05.pdf', 'Assets:Savings', datetime.date(2016, 5, 14)),
+    ('Statement_Feb 2016.pdf', 'Liabilities:Amex', datetime.date(2016, 2, 27)),
+    ('other_2016_may.pdf', 'Assets:Other', datetime.date(2016, 5, 31)),
+    ('no-match.pdf', 'Assets:Fallback', None),
+]
+
+@pytest.mark.parametrize('filename,expected_account,expected_date', dispatch_data)
+def test_dispatch(filename, expected_account, expected_date):
+    importer = make_importer()
+    file = cache.get_file(path.join(DATADIR, filename))
+
+    assert importer.identify(file)
+    assert importer.file_account(file) == expected_account
+    assert importer.file_date(file) == expected_date
+    assert importer.extract(file) == []
+
+
+def test_first_importer_wins():
+    importer = dispatch.Importer([
+        filing.Importer('Assets:First', filename_regexp=r'^test_(?P<year>\d{4})'),
+        filing.Importer('Assets:Second', filename_regexp=r'^test_(?P<year>\d{4})'),
+    ])
+    file = cache.get_file(path.join(DATADIR, 'test_2016_05.pdf'))
+    assert importer.file_account(file) == 'Assets:First'
+    assert importer.file_name(file) is None
+
+
+def test_earlier_importers_are_probed_first():
+    importer = dispatch.Importer([
+        testing.ConstImporter([], 'Assets:First'),
+        filing.Importer('Assets:Second', filename_regexp=r'^test_(?P<year>\d{4})'),
+    ])
+    file = cache.get_file(path.join(DATADIR, 'test_2016_05.pdf'))
+    assert importer.file_account(file) == 'Assets:First'
+
+
+def test_single_filename_match(monkeypatch):
+    # The combined match is enough to accept a file for filing importers
+    def identify(self, file):
+        raise AssertionError('the filename is matched twice')
+    monkeypatch.setattr(filing.Importer, 'identify', identify)
+
+    importer = make_importer()
+    file = cache.get_file(path.join(DATADIR, 'checking_2016-05.pdf'))
+    assert importer.file_account(file) == 'Assets:Checking'
+
+
+class FixedDateImporter(filing.Importer):
+    def file_date(self, file):
+        return datetime.date(2000, 1, 1)
+
+
+def test_file_date_override():
+    importer = dispatch.Importer([
+        FixedDateImporter('Assets:Fixed', filename_regexp=r'^test_(?P<year>\d{4})'),
+    ])
+    file = cache.get_file(path.join(DATADIR, 'test_2016_05.pdf'))
+    assert importer.file_date(file) == datetime.date(2000, 1, 1)
+
+
+def test_no_importers():
+    importer = dispatch.Importer([])
+    file = cache.get_file(path.join(DATADIR, 'test.pdf'))
+    assert not importer.identify(file)
+    assert importer.file_account(file) is None
+    assert importer.file_date(file) is None
+    assert importer.extract(file) == []
+
+
+prefix_groups_data = [
+    (r'^a(?P<year>\d{4})b$', r'^a(?P<x_year>\d{4})b$'),
+    (r'(?P<a>x)(?P=a)', r'(?P<x_a>x)(?P=x_a)'),
+    (r'\(?P<a>x\)', r'\(?P<a>x\)'),
+]
+
+@pytest.mark.parametrize('pattern,expected', prefix_groups_data)
+def test_prefix_groups(pattern, expected):
+    assert dispatch.prefix_groups(pattern, 'x_') == expected
@@ -1,12 +1,19 @@
 """Unit tests for beansoup.importers.mixins module."""
 
+import collections
+import datetime
+import functools
+import os
 from os import path
+import pytest
 import tempfile
+import threading
 
 from beancount import loader
 from beancount.ingest import cache
 from beancount.parser import cmptest
 
+from beansoup import transactions
 from beansoup.importers import mixins
 from beansoup.utils import testing
 
@@ -52,3 +59,245 @@ class TestFilterChainMixin(cmptest.TestCase):
                             filters=[filter_last_two])
         extracted_entries = importer.extract(file)
         self.assertEqualEntries(extracted_entries, entries[-2:])
+
+    @loader.load_doc(expect_errors=True)
+    def test_streaming_filters(self, entries, errors, _):
+        """
+        2014-05-19 * "Verizon Wireless" ""
+          Assets:US:BofA:Checking                          -44.34 USD
+        
+        2014-05-23 * "Wine-Tarner Cable" ""
+          Assets:US:BofA:Checking                          -80.17 USD
+        
+        2014-06-04 * "BANK FEES" "Monthly bank fee"
+          Assets:US:BofA:Checking                           -4.00 USD
+        
+        2014-06-08 * "EDISON POWER" ""
+          Assets:US:BofA:Checking                          -65.00 USD
+        """
+        trace = []
+
+        @mixins.streaming
+        def trace_first(entries):
+            for entry in entries:
+                trace.append(('first', entry.payee))
+                yield entry
+
+        @mixins.streaming
+        def skip_fees(entries):
+            for entry in entries:
+                trace.append(('second', entry.payee))
+                if entry.payee != 'BANK FEES':
+                    yield entry
+
+        def filter_last_two(entries):
+            assert isinstance(entries, list)
+            return entries[-2:]
+
+        file = cache.get_file(path.join(tempfile.gettempdir(), 'test'))
+        importer = Importer(entries, 'Assets:US:BofA:Checking',
+                            filters=[trace_first, skip_fees, filter_last_two])
+        extracted_entries = importer.extract(file)
+        self.assertEqualEntries(extracted_entries, [entries[1], entries[3]])
+
+        # The streaming filters are pipelined
+        self.assertEqual(trace[:4], [('first', 'Verizon Wireless'),
+                                     ('second', 'Verizon Wireless'),
+                                     ('first', 'Wine-Tarner Cable'),
+                                     ('second', 'Wine-Tarner Cable')])
+
+        # A chain made only of streaming filters still returns a list
+        importer = Importer(entries, 'Assets:US:BofA:Checking',
+                            filters=[skip_fees])
+        extracted_entries = importer.extract(file)
+        self.assertIsInstance(extracted_entries, list)
+        self.assertEqual(len(extracted_entries), 3)
+
+    @loader.load_doc(expect_errors=True)
+    def test_metrics(self, entries, errors, _):
+        """
+        2014-05-19 * "Verizon Wireless" ""
+          Assets:US:BofA:Checking                          -44.34 USD
+        
+        2014-05-23 * "Wine-Tarner Cable" ""
+          Assets:US:BofA:Checking                          -80.17 USD
+        
+        2014-06-04 * "BANK FEES" "Monthly bank fee"
+          Assets:US:BofA:Checking                           -4.00 USD
+        
+        2014-06-08 * "EDISON POWER" ""
+          Assets:US:BofA:Checking                          -65.00 USD
+        """
+        @mixins.streaming
+        def tag_fees(entries):
+            for entry in entries:
+                if entry.payee == 'BANK FEES':
+                    entry = entry._replace(tags={'fees'})
+                yield entry
+
+        def complete_last(entries):
+            entries[-1].postings.append(entries[-1].postings[0])
+            return entries
+
+        def filter_last_two(entries):
+            return entries[-2:]
+
+        reports = []
+        file = cache.get_file(path.join(tempfile.gettempdir(), 'test'))
+        importer = Importer(entries, 'Assets:US:BofA:Checking',
+                            filters=[tag_fees, complete_last, filter_last_two],
+                            metrics=lambda file, stats: reports.append((file, stats)))
+        extracted_entries = importer.extract(file)
+        self.assertEqual(len(extracted_entries), 2)
+
+        self.assertEqual(len(reports), 1)
+        report_file, stats = reports[0]
+        self.assertIs(report_file, file)
+        self.assertEqual([(s.name, s.num_in, s.num_out, s.num_modified) for s in stats],
+                         [('tag_fees', 4, 4, 1),
+                          ('complete_last', 4, 4, 1),
+                          ('filter_last_two', 4, 2, 0)])
+        self.assertTrue(all(s.elapsed >= 0 for s in stats))
+
+
+class CachedImporter(mixins.ExtractCache, mixins.FilterChain, testing.ConstImporter):
+    pass
+
+
+# The number of entries passed to each call of count_calls; it is not held
+# in a closure, which would make it part of the cache key.
+calls = []
+
+
+def count_calls(entries):
+    calls.append(len(entries))
+    return entries
+
+
+class TestExtractCacheMixin(cmptest.TestCase):
+
+    @loader.load_doc(expect_errors=True)
+    def test_mixin(self, entries, errors, _):
+        """
+        2014-05-19 * "Verizon Wireless" ""
+          Assets:US:BofA:Checking                          -44.34 USD
+
+        2014-05-23 * "Wine-Tarner Cable" ""
+          Assets:US:BofA:Checking                          -80.17 USD
+        """
+        del calls[:]
+        with tempfile.TemporaryDirectory() as cache_dir, \
+             tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(b'04/01/2016,RLS,404.38,,5194.21\n')
+            f.flush()
+            file = cache.get_file(f.name)
+
+            def make_importer(entries, cache_key=''):
+                return CachedImporter(entries, 'Assets:US:BofA:Checking',
+                                      filters=[count_calls],
+                                      cache_dir=cache_dir, cache_key=cache_key)
+
+            # The first extraction fills the cache; the next one hits it
+            self.assertEqualEntries(make_importer(entries).extract(file), entries)
+            self.assertEqualEntries(make_importer(entries).extract(file), entries)
+            self.assertEqual(calls, [2])
+
+            # A change in the importer configuration invalidates the cache
+            self.assertEqualEntries(make_importer(entries[:1]).extract(file), entries[:1])
+            self.assertEqual(calls, [2, 1])
+
+            # So does a change in the user-provided key
+            make_importer(entries, cache_key='ledger-v2').extract(file)
+            self.assertEqual(calls, [2, 1, 2])
+
+            # Without a cache directory, the cache is disabled
+            CachedImporter(entries, 'Assets:US:BofA:Checking',
+                           filters=[count_calls]).extract(file)
+            self.assertEqual(calls, [2, 1, 2, 2])
+
+            # A file with the same contents under another name is extracted
+            # again, since the entries refer to the file by name
+            with tempfile.NamedTemporaryFile(suffix='.csv') as g:
+                g.write(b'04/01/2016,RLS,404.38,,5194.21\n')
+                g.flush()
+                make_importer(entries).extract(cache.get_file(g.name))
+            self.assertEqual(calls, [2, 1, 2, 2, 2])
+
+
+def test_fingerprint():
+    assert mixins.fingerprint({'b', 'a'}) == mixins.fingerprint({'a', 'b'})
+    assert mixins.fingerprint([1, 'x']) != mixins.fingerprint([1, 'y'])
+
+    class Node:
+        def __init__(self):
+            self.callback = self.method
+
+        def method(self):
+            pass
+
+    # Reference cycles are cut and memory addresses are not included
+    assert mixins.fingerprint(Node()) == mixins.fingerprint(Node())
+
+
+def make_adder(increment):
+    def add(value):
+        return value + increment
+    return add
+
+
+def add(value, increment):
+    return value + increment
+
+
+def test_fingerprint_functions():
+    # The configuration of partial objects and closures is described
+    assert (mixins.fingerprint(functools.partial(add, increment=1)) !=
+            mixins.fingerprint(functools.partial(add, increment=2)))
+    assert (mixins.fingerprint(functools.partial(add, increment=1)) ==
+            mixins.fingerprint(functools.partial(add, increment=1)))
+    assert mixins.fingerprint(make_adder(1)) != mixins.fingerprint(make_adder(2))
+    assert mixins.fingerprint(make_adder(1)) == mixins.fingerprint(make_adder(1))
+    # So is the code of functions
+    assert (mixins.fingerprint(lambda value: value + 1) !=
+            mixins.fingerprint(lambda value: value + 2))
+
+
+class Slotted:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def test_fingerprint_objects_without_attributes():
+    # Objects are described by their slots or the way they are pickled
+    assert (mixins.fingerprint(datetime.timedelta(1)) !=
+            mixins.fingerprint(datetime.timedelta(60)))
+    assert (mixins.fingerprint(collections.deque([1, 2])) !=
+            mixins.fingerprint(collections.deque([1, 3])))
+    assert mixins.fingerprint(Slotted(1)) != mixins.fingerprint(Slotted(2))
+    assert mixins.fingerprint(Slotted(1)) == mixins.fingerprint(Slotted(1))
+    completers = [transactions.TransactionCompleter([], 'Assets:Cash', max_age=max_age)
+                  for max_age in (datetime.timedelta(1), datetime.timedelta(60))]
+    assert mixins.fingerprint(completers[0]) != mixins.fingerprint(completers[1])
+    with pytest.raises(TypeError):
+        mixins.fingerprint(threading.Lock())
+
+
+def test_undescribable_configuration():
+    calls = []
+
+    def count_lock_calls(entries, lock=threading.Lock()):
+        calls.append(len(entries))
+        return entries
+
+    with tempfile.TemporaryDirectory() as cache_dir, \
+         tempfile.NamedTemporaryFile(suffix='.csv') as f:
+        file = cache.get_file(f.name)
+        importer = CachedImporter([], 'Assets:US:BofA:Checking',
+                                  filters=[count_lock_calls], cache_dir=cache_dir)
+        # The cache is bypassed
+        importer.extract(file)
+        importer.extract(file)
+        assert calls == [0, 0]
+        assert os.listdir(cache_dir) == []
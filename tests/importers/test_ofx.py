@@ -0,0 +1,158 @@
+"""Unit tests for beansoup.importers.ofx module."""
+
+import datetime
+import logging
+import pytest
+import tempfile
+
+from beancount.ingest import cache
+from beancount.parser import cmptest
+
+from beansoup.importers import csv
+from beansoup.importers import ofx
+from beansoup.utils import testing
+
+
+class TestOFXImporter(cmptest.TestCase):
+
+    @testing.docfile(mode='w', suffix='.ofx')
+    def test_sgml(self, filename):
+        """\
+        OFXHEADER:100
+        DATA:OFXSGML
+        VERSION:102
+        ENCODING:USASCII
+        CHARSET:1252
+
+        <OFX>
+        <SIGNONMSGSRSV1><SONRS><STATUS><CODE>0<SEVERITY>INFO</STATUS>
+        <DTSERVER>20160502120000</SONRS></SIGNONMSGSRSV1>
+        <BANKMSGSRSV1><STMTTRNRS><TRNUID>1
+        <STMTRS>
+        <CURDEF>CAD
+        <BANKACCTFROM><BANKID>0004<ACCTID>12345<ACCTTYPE>CHECKING</BANKACCTFROM>
+        <BANKTRANLIST><DTSTART>20160401<DTEND>20160430
+        <STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20160405120000[-5:EST]<TRNAMT>-60.24
+        <FITID>2<NAME>COSTCO #9876543</STMTTRN>
+        <STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20160401<TRNAMT>-404.38
+        <FITID>1<NAME>12-345 Smith<MEMO>RLS</STMTTRN>
+        <STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20160502<TRNAMT>345,24
+        <FITID>3<NAME>CANADA RIT</STMTTRN>
+        </BANKTRANLIST>
+        <LEDGERBAL><BALAMT>5474.83<DTASOF>20160502</LEDGERBAL>
+        <AVAILBAL><BALAMT>1000.00<DTASOF>20160502</AVAILBAL>
+        </STMTRS></STMTTRNRS></BANKMSGSRSV1>
+        </OFX>
+        """
+        file = cache.get_file(filename)
+
+        account = 'Assets:TD:Checking'
+        importer = ofx.Importer(account, 'CAD', 'td-checking', first_day=1)
+
+        assert importer.file_account(file) == account
+        assert importer.file_name(file) == 'td-checking.ofx'
+        assert importer.identify(file)
+        assert importer.file_date(file) == datetime.date(2016, 5, 31)
+        assert not ofx.Importer(account, acctid='54321').identify(file)
+
+        entries = importer.extract(file)
+        self.assertEqualEntries("""
+        2016-04-01 * "12-345 Smith / RLS"
+          Assets:TD:Checking  -404.38 CAD
+
+        2016-04-05 * "COSTCO #9876543"
+          Assets:TD:Checking  -60.24 CAD
+
+        2016-05-02 * "CANADA RIT"
+          Assets:TD:Checking  345.24 CAD
+
+        2016-05-01 balance Assets:TD:Checking   5129.59 CAD
+        2016-06-01 balance Assets:TD:Checking   5474.83 CAD
+        """, entries)
+
+    @testing.docfile(mode='w', suffix='.qfx')
+    def test_xml(self, filename):
+        """\
+        <?xml version="1.0" encoding="UTF-8" standalone="no"?>
+        <?OFX OFXHEADER="200" VERSION="211" SECURITY="NONE"?>
+        <OFX><CREDITCARDMSGSRSV1><CCSTMTTRNRS><CCSTMTRS>
+          <CURDEF>CAD</CURDEF>
+          <CCACCTFROM><ACCTID>4111</ACCTID></CCACCTFROM>
+          <BANKTRANLIST>
+            <STMTTRN><TRNTYPE>DEBIT</TRNTYPE><DTPOSTED>20151206</DTPOSTED>
+              <TRNAMT>-14.00</TRNAMT><NAME>SKYPE</NAME><MEMO></MEMO></STMTTRN>
+            <STMTTRN><TRNTYPE>CREDIT</TRNTYPE><DTPOSTED>20151213</DTPOSTED>
+              <TRNAMT>97.62</TRNAMT><NAME>PAYMENT - THANK YOU</NAME></STMTTRN>
+          </BANKTRANLIST>
+        </CCSTMTRS></CCSTMTTRNRS></CREDITCARDMSGSRSV1></OFX>
+        """
+        file = cache.get_file(filename)
+
+        account = 'Liabilities:TD:Visa'
+        importer = ofx.Importer(account, 'CAD', acctid='4111', first_day=4)
+        assert importer.identify(file)
+        assert importer.file_date(file) == datetime.date(2016, 1, 3)
+
+        # The statement has no ledger balance, so no balance directive
+        entries = importer.extract(file)
+        self.assertEqualEntries("""
+        2015-12-06 * "SKYPE"
+          Liabilities:TD:Visa  -14.00 CAD
+
+        2015-12-13 * "PAYMENT - THANK YOU"
+          Liabilities:TD:Visa  97.62 CAD
+        """, entries)
+
+    @testing.docfile(mode='w', suffix='.ofx')
+    def test_not_ofx(self, filename):
+        """\
+        04/01/2016,12-345 Smith    RLS,404.38,,5194.21
+        """
+        file = cache.get_file(filename)
+        importer = ofx.Importer('Assets:TD:Checking')
+        assert not importer.identify(file)
+        assert importer.extract(file) == []
+
+
+OFX_TEMPLATE = """\
+OFXHEADER:100
+<OFX><STMTRS><CURDEF>{}
+<BANKACCTFROM><ACCTID>12345</BANKACCTFROM>
+<BANKTRANLIST>
+<STMTTRN><DTPOSTED>20160405<TRNAMT>-60.24<NAME>CAF\u00c9 DU MONDE</STMTTRN>
+</BANKTRANLIST>
+<LEDGERBAL><BALAMT>100.00<DTASOF>20160502</LEDGERBAL>
+</STMTRS></OFX>
+"""
+
+
+@pytest.mark.parametrize('currency,num_warnings', [('CAD', 0), ('USD', 1)])
+def test_statement_currency(currency, num_warnings, caplog, monkeypatch):
+    # The head of the file used to guess its encoding is plain ASCII
+    monkeypatch.setattr(csv, 'ENCODING_DETECT_MAX_BYTES', 32)
+    with tempfile.NamedTemporaryFile(suffix='.ofx') as f:
+        f.write(OFX_TEMPLATE.format(currency).encode('latin-1'))
+        f.flush()
+        file = cache.get_file(f.name)
+        importer = ofx.Importer('Assets:TD:Checking', 'CAD')
+        with caplog.at_level(logging.WARNING):
+            entries = importer.extract(file)
+        assert entries[0].narration == 'CAF\u00c9 DU MONDE'
+        assert len([record for record in caplog.records
+                    if 'the statement is in' in record.getMessage()]) == num_warnings
+
+
+@pytest.mark.parametrize('size', [1, 2, 5, 1024])
+def test_iter_tokens_chunks(size):
+    text = ('OFXHEADER:100\n<OFX><STMTTRN><TRNAMT>-1.50\n<NAME>A &amp; B</NAME>'
+            '<!-- comment --></STMTTRN></OFX>')
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+    assert list(ofx.iter_tokens(chunks)) == [
+        (False, 'OFX', ''),
+        (False, 'STMTTRN', ''),
+        (False, 'TRNAMT', '-1.50'),
+        (False, 'NAME', 'A & B'),
+        (True, 'NAME', ''),
+        (True, 'STMTTRN', ''),
+        (True, 'OFX', ''),
+    ]
@@ -1,6 +1,12 @@
 """Unit tests for deposit_in_transit plugin."""
 
+import json
+import os
+import tempfile
+import textwrap
+
 from beancount import loader
+from beancount.core import data
 from beancount.parser import cmptest
 
 from beansoup.plugins import config
@@ -238,3 +244,314 @@ class TestClearTransactions(cmptest.TestCase):
         2000-01-01 open Liabilities:Visa
         2000-01-01 open Liabilities:Clearing:Visa
         """, entries)
+
+    @loader.load_doc()
+    def test_matching_order(self, entries, errors, _):
+        """
+        plugin "beansoup.plugins.clear_transactions" "
+        Assets:Clearing:Checking,Assets:Checking"
+        
+        2000-01-01 open Assets:Savings
+        2000-01-01 open Assets:Checking
+        2000-01-01 open Assets:Clearing:Checking
+        
+        2000-02-01 * "Deposit into checking"
+          Assets:Checking         100.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-02 * "Withdrawal from checking"
+          Assets:Checking        -100.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-03 * "Withdrawal from savings"
+          Assets:Savings         -100.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-04 * "Deposit into savings"
+          Assets:Savings          100.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-05 * "Withdrawal from savings"
+          Assets:Savings         -100.00 USD
+          Assets:Clearing:Checking
+        """
+        self.assertFalse(errors)
+        self.assertEqualEntries("""
+        2000-01-01 open Assets:Savings
+        2000-01-01 open Assets:Checking
+        2000-01-01 open Assets:Clearing:Checking
+        
+        2000-02-01 * "Deposit into checking" #CLEARED ^cleared-1
+          Assets:Checking            100.00 USD
+          Assets:Clearing:Checking  -100.00 USD
+        
+        2000-02-02 * "Withdrawal from checking" #CLEARED ^cleared-2
+          Assets:Checking           -100.00 USD
+          Assets:Clearing:Checking   100.00 USD
+        
+        2000-02-03 * "Withdrawal from savings" #CLEARED ^cleared-1
+          Assets:Savings            -100.00 USD
+          Assets:Clearing:Checking   100.00 USD
+        
+        2000-02-04 * "Deposit into savings" #CLEARED ^cleared-2
+          Assets:Savings             100.00 USD
+          Assets:Clearing:Checking  -100.00 USD
+        
+        2000-02-05 * "Withdrawal from savings" #PENDING
+          Assets:Savings            -100.00 USD
+          Assets:Clearing:Checking   100.00 USD
+        """, entries)
+
+    @loader.load_doc()
+    def test_optimal_matching_option(self, entries, errors, _):
+        """
+        plugin "beansoup.plugins.clear_transactions" "
+        --max_days 7 --optimal_matching
+        Assets:Clearing:Checking,Assets:Checking"
+        
+        2000-01-01 open Assets:Savings
+        2000-01-01 open Assets:Checking
+        2000-01-01 open Assets:Clearing:Checking
+        
+        2000-01-30 * "Withdrawal from savings"
+          Assets:Savings         -100.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-04 * "Withdrawal from savings"
+          Assets:Savings         -100.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-05 * "Deposit into checking"
+          Assets:Checking         100.00 USD
+          Assets:Clearing:Checking
+        """
+        self.assertFalse(errors)
+        self.assertEqualEntries("""
+        2000-01-01 open Assets:Savings
+        2000-01-01 open Assets:Checking
+        2000-01-01 open Assets:Clearing:Checking
+        
+        2000-01-30 * "Withdrawal from savings" #PENDING
+          Assets:Savings            -100.00 USD
+          Assets:Clearing:Checking   100.00 USD
+        
+        2000-02-04 * "Withdrawal from savings" #CLEARED ^cleared-1
+          Assets:Savings            -100.00 USD
+          Assets:Clearing:Checking   100.00 USD
+        
+        2000-02-05 * "Deposit into checking" #CLEARED ^cleared-1
+          Assets:Checking            100.00 USD
+          Assets:Clearing:Checking  -100.00 USD
+        """, entries)
+
+    @loader.load_doc()
+    def test_max_split_option(self, entries, errors, _):
+        """
+        plugin "beansoup.plugins.clear_transactions" "
+        --max_split 3
+        Assets:Clearing:Checking,Assets:Checking"
+        
+        2000-01-01 open Assets:Savings
+        2000-01-01 open Assets:Checking
+        2000-01-01 open Assets:Clearing:Checking
+        
+        2000-02-01 * "Withdrawal from checking"
+          Assets:Checking        -300.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-02 * "Deposit into savings"
+          Assets:Savings           50.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-02 * "Deposit into savings"
+          Assets:Savings          100.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-03 * "Deposit into savings"
+          Assets:Savings          200.00 USD
+          Assets:Clearing:Checking
+        """
+        self.assertFalse(errors)
+        self.assertEqualEntries("""
+        2000-01-01 open Assets:Savings
+        2000-01-01 open Assets:Checking
+        2000-01-01 open Assets:Clearing:Checking
+        
+        2000-02-01 * "Withdrawal from checking" #CLEARED ^cleared-1
+          Assets:Checking           -300.00 USD
+          Assets:Clearing:Checking   300.00 USD
+        
+        2000-02-02 * "Deposit into savings" #PENDING
+          Assets:Savings              50.00 USD
+          Assets:Clearing:Checking   -50.00 USD
+        
+        2000-02-02 * "Deposit into savings" #CLEARED ^cleared-1
+          Assets:Savings             100.00 USD
+          Assets:Clearing:Checking  -100.00 USD
+        
+        2000-02-03 * "Deposit into savings" #CLEARED ^cleared-1
+          Assets:Savings             200.00 USD
+          Assets:Clearing:Checking  -200.00 USD
+        """, entries)
+
+    @loader.load_doc()
+    def test_in_place(self, entries, errors, options_map):
+        """
+        2000-01-01 open Assets:Savings
+        2000-01-01 open Assets:Checking
+        2000-01-01 open Assets:Clearing:Checking
+        
+        2000-02-01 * "Withdrawal from checking"
+          Assets:Checking        -100.00 USD
+          Assets:Clearing:Checking
+        
+        2000-02-02 * "Deposit into savings"
+          Assets:Savings          100.00 USD
+          Assets:Clearing:Checking
+        """
+        config_string = 'Assets:Clearing:Checking,Assets:Checking'
+        original_entries = list(entries)
+
+        new_entries, errors = clear_transactions.clear_transactions(
+            entries, options_map, config_string)
+        self.assertFalse(errors)
+        self.assertEqual(entries, original_entries)
+        self.assertEqual(new_entries[:3], entries[:3])
+        self.assertEqual(new_entries[3].tags, {'CLEARED'})
+
+        same_entries, errors = clear_transactions.clear_transactions_in_place(
+            entries, options_map, config_string)
+        self.assertFalse(errors)
+        self.assertIs(same_entries, entries)
+        self.assertEqual(entries, new_entries)
+
+
+STATE_LEDGER = textwrap.dedent("""\
+    plugin "beansoup.plugins.clear_transactions" "
+    {}
+    Assets:Clearing:Checking,Assets:Checking"
+
+    2000-01-01 open Assets:Savings
+    2000-01-01 open Assets:Checking
+    2000-01-01 open Assets:Clearing:Checking
+
+    2000-02-01 * "Withdrawal from checking"
+      Assets:Checking        -100.00 USD
+      Assets:Clearing:Checking
+
+    2000-02-02 * "Deposit into savings"
+      Assets:Savings          100.00 USD
+      Assets:Clearing:Checking
+
+    2000-02-05 * "Withdrawal from checking"
+      Assets:Checking         -50.00 USD
+      Assets:Clearing:Checking
+
+    2000-03-01 * "Withdrawal from checking"
+      Assets:Checking         -20.00 USD
+      Assets:Clearing:Checking
+    """)
+
+
+def test_state_file():
+    with tempfile.TemporaryDirectory() as state_dir:
+        state_filename = os.path.join(state_dir, 'state.json')
+        options = '--state_file {}'.format(state_filename)
+        new_txn = textwrap.dedent("""
+            2000-03-02 * "Deposit into savings"
+              Assets:Savings           20.00 USD
+              Assets:Clearing:Checking
+            """)
+
+        # The last load of the unchanged ledger must not rename the links
+        for ledger in (STATE_LEDGER, STATE_LEDGER + new_txn, STATE_LEDGER + new_txn):
+            expected_entries, _, _ = loader.load_string(ledger.format(''))
+            entries, errors, _ = loader.load_string(ledger.format(options))
+            assert not errors
+            assert entries == expected_entries
+
+        # Only the transactions that cannot be affected by new ones are frozen
+        with open(state_filename) as state_file:
+            state = json.load(state_file)
+        account_state = state['accounts']['Assets:Clearing:Checking']
+        assert account_state['last_date'] == '2000-03-02'
+        assert list(account_state['links']) == ['cleared-1']
+        assert len(account_state['pending']) == 1
+        assert len(account_state['recent']) == 2
+
+
+CHAINED_STATE_LEDGER = textwrap.dedent("""\
+    plugin "beansoup.plugins.clear_transactions" "
+    --optimal_matching {}
+    Assets:Clearing:Checking,Assets:Checking"
+
+    2000-01-01 open Assets:Savings
+    2000-01-01 open Assets:Checking
+    2000-01-01 open Assets:Clearing:Checking
+
+    2000-01-01 * "Deposit into savings"
+      Assets:Savings          100.00 USD
+      Assets:Clearing:Checking
+
+    2000-01-08 * "Withdrawal from checking"
+      Assets:Checking        -100.00 USD
+      Assets:Clearing:Checking
+
+    2000-01-11 * "Deposit into savings"
+      Assets:Savings          100.00 USD
+      Assets:Clearing:Checking
+
+    2000-01-18 * "Withdrawal from checking"
+      Assets:Checking        -100.00 USD
+      Assets:Clearing:Checking
+
+    2000-01-21 * "Deposit into savings"
+      Assets:Savings          100.00 USD
+      Assets:Clearing:Checking
+    """)
+
+
+def test_state_file_chained_windows():
+    with tempfile.TemporaryDirectory() as state_dir:
+        state_filename = os.path.join(state_dir, 'state.json')
+        options = '--state_file {}'.format(state_filename)
+        new_txn = textwrap.dedent("""
+            2000-01-28 * "Withdrawal from checking"
+              Assets:Checking        -100.00 USD
+              Assets:Clearing:Checking
+            """)
+
+        # The new transaction re-pairs all the others
+        for ledger in (CHAINED_STATE_LEDGER, CHAINED_STATE_LEDGER + new_txn):
+            expected_entries, _, _ = loader.load_string(ledger.format(''))
+            entries, errors, _ = loader.load_string(ledger.format(options))
+            assert not errors
+            assert entries == expected_entries
+        assert all('CLEARED' in entry.tags
+                   for entry in entries if isinstance(entry, data.Transaction))
+
+
+def test_state_file_edited_transaction():
+    with tempfile.TemporaryDirectory() as state_dir:
+        state_filename = os.path.join(state_dir, 'state.json')
+        options = '--state_file {}'.format(state_filename)
+        ledger = STATE_LEDGER + textwrap.dedent("""
+            2000-01-01 open Expenses:Misc
+
+            2000-03-02 * "Deposit into savings"
+              Assets:Savings           20.00 USD
+              Assets:Clearing:Checking
+            """)
+        # The main account posting of a frozen transaction is edited, so
+        # that it cannot be paired anymore
+        edited_ledger = ledger.replace('Assets:Checking        -100.00 USD',
+                                       'Expenses:Misc          -100.00 USD')
+        assert edited_ledger != ledger
+
+        for ledger in (ledger, edited_ledger):
+            expected_entries, _, _ = loader.load_string(ledger.format(''))
+            entries, errors, _ = loader.load_string(ledger.format(options))
+            assert not errors
+            assert entries == expected_entries
+        assert [sorted(entry.tags) for entry in entries
+                if isinstance(entry, data.Transaction)][:2] == [['PENDING'], ['PENDING']]
@@ -0,0 +1,86 @@
+"""Unit tests for combined plugin."""
+
+import textwrap
+import pytest
+
+from beancount import loader
+from beancount.parser import cmptest
+
+from beansoup.plugins import combined
+from beansoup.plugins import config
+
+
+LEDGER = textwrap.dedent("""\
+    {}
+
+    2000-01-01 open Assets:Checking
+    2000-01-01 open Assets:Savings
+    2000-01-01 open Assets:Clearing:Checking
+    2000-01-01 open Liabilities:Visa
+
+    2000-02-01 * "Transfer to checking"
+      Assets:Savings         -500.00 USD
+      Assets:DIT:Checking
+
+    2000-02-03 * "Transfer from savings"
+      Assets:Checking         500.00 USD
+      Assets:DIT:Savings
+
+    2000-02-07 * "Visa payment"
+      Assets:Checking        -100.00 USD
+      Liabilities:DIT:Visa
+
+    2000-02-08 * "Cheque"
+      Assets:Savings         -200.00 USD
+      Assets:Clearing:Checking
+
+    2000-02-09 * "Cheque deposit"
+      Assets:Checking         200.00 USD
+      Assets:Clearing:Checking
+
+    2000-02-20 * "Unmatched cheque"
+      Assets:Savings          -50.00 USD
+      Assets:Clearing:Checking
+    """)
+
+DIT_CONFIG = '--auto_open --flag_pending --link_prefix=deposited'
+CLEAR_CONFIG = '--flag_pending Assets:Clearing:Checking,Assets:Checking'
+
+
+class TestCombined(cmptest.TestCase):
+
+    def test_same_as_sequential_plugins(self):
+        sequential_entries, errors, _ = loader.load_string(LEDGER.format('\n'.join([
+            'plugin "beansoup.plugins.deposit_in_transit" "{}"'.format(DIT_CONFIG),
+            'plugin "beansoup.plugins.clear_transactions" "{}"'.format(CLEAR_CONFIG)])))
+        self.assertFalse(errors)
+        entries, errors, _ = loader.load_string(LEDGER.format(
+            'plugin "beansoup.plugins.combined" "deposit_in_transit: {} clear_transactions: {}"'.format(
+                DIT_CONFIG, CLEAR_CONFIG)))
+        self.assertFalse(errors)
+        self.assertEqualEntries(sequential_entries, entries)
+
+    def test_single_plugin(self):
+        # There will be errors about the DIT unknown accounts
+        expected_entries, expected_errors, _ = loader.load_string(LEDGER.format(
+            'plugin "beansoup.plugins.clear_transactions" "{}"'.format(CLEAR_CONFIG)))
+        entries, errors, _ = loader.load_string(LEDGER.format(
+            'plugin "beansoup.plugins.combined" "clear_transactions: {}"'.format(CLEAR_CONFIG)))
+        self.assertEqual(len(errors), len(expected_errors))
+        self.assertEqualEntries(expected_entries, entries)
+
+    def test_invalid_account(self):
+        entries, errors, _ = loader.load_string(LEDGER.format(
+            'plugin "beansoup.plugins.combined" "deposit_in_transit: {} clear_transactions: {}"'.format(
+                DIT_CONFIG, 'Assets:Clearing:Visa,Liabilities:Visa')))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(type(errors[0]), config.ParseError)
+
+
+@pytest.mark.parametrize('config_string', [
+    '--auto_open',
+    'deposit_in_transit: --auto_open deposit_in_transit: --flag_pending',
+])
+def test_split_config_errors(config_string):
+    with pytest.raises(config.ParseError):
+        combined.split_config(config_string, '<string>')
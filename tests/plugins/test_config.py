@@ -38,3 +38,30 @@ def test_re_type():
     with pytest.raises(config.ParseError) as excinfo:
         args = parser.parse_args('--test_re [a-'.split())
     assert 'invalid regular expression' in excinfo.value.message
+
+
+def test_parse_args_cache():
+    calls = []
+
+    def create_parser(entries_filename):
+        calls.append(entries_filename)
+        parser = config.ArgumentParser(entries_filename=entries_filename)
+        parser.add_argument('--max_days', type=int, default=7)
+        return parser
+
+    _, args = config.parse_args(create_parser, 'ledger.beancount', '--max_days 3')
+    args.max_days = 5
+    parser, args = config.parse_args(create_parser, 'ledger.beancount', '--max_days 3')
+    assert args.max_days == 3
+    assert calls == ['ledger.beancount']
+    assert isinstance(parser, config.ArgumentParser)
+
+    config.parse_args(create_parser, 'other.beancount', None)
+    assert calls == ['ledger.beancount', 'other.beancount']
+
+    for _ in range(2):
+        with pytest.raises(config.ParseError) as excinfo:
+            config.parse_args(create_parser, 'ledger.beancount', '--max_days X')
+        assert 'invalid int value' in excinfo.value.message
+        assert excinfo.value.source['filename'] == 'ledger.beancount'
+    assert len(calls) == 3
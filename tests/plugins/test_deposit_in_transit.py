@@ -1,6 +1,10 @@
 """Unit tests for deposit_in_transit plugin."""
 
+import datetime
+import pytest
+
 from beancount import loader
+from beancount.core import data
 from beancount.parser import cmptest
 
 from beansoup.plugins import config
@@ -231,3 +235,111 @@ class TestDepositInTransit(cmptest.TestCase):
           Liabilities:Visa      100.00 USD
           Assets:DIT:Checking  -100.00 USD
         """, entries)
+
+    @loader.load_doc()
+    def test_matching_accounts_and_dates(self, entries, errors, _):
+        """
+        plugin "beansoup.plugins.deposit_in_transit" "
+        --auto_open --link_prefix=deposited --max_days=5"
+        
+        2000-01-01 open Assets:Checking
+        2000-01-01 open Assets:Savings
+        2000-01-01 open Liabilities:Visa
+        
+        2000-02-01 * "Too far from the deposit"
+          Assets:Savings         -100.00 USD
+          Assets:DIT:Checking
+        
+        2000-03-01 * "Not from the right account"
+          Liabilities:Visa       -100.00 USD
+          Assets:DIT:Checking
+        
+        2000-03-02 * "Transfer"
+          Assets:Savings         -100.00 USD
+          Assets:DIT:Checking
+        
+        2000-03-03 * "Deposit"
+          Assets:Checking         100.00 USD
+          Assets:DIT:Savings
+        """
+        self.assertFalse(errors)
+        self.assertEqualEntries("""
+        2000-01-01 open Assets:Checking
+        2000-01-01 open Assets:Savings
+        2000-01-01 open Liabilities:Visa
+        2000-02-01 open Assets:DIT:Checking
+        
+        2000-02-01 * "Too far from the deposit" #IN-TRANSIT
+          Assets:Savings        -100.00 USD
+          Assets:DIT:Checking    100.00 USD
+        
+        2000-03-01 * "Not from the right account" #IN-TRANSIT
+          Liabilities:Visa      -100.00 USD
+          Assets:DIT:Checking    100.00 USD
+        
+        2000-03-02 * "Transfer" #DEPOSITED ^deposited-1
+          Assets:Savings        -100.00 USD
+          Assets:DIT:Checking    100.00 USD
+        
+        2000-03-03 open Assets:DIT:Savings
+        
+        2000-03-03 * "Transfer / Deposit" #DEPOSITED ^deposited-1
+          Assets:DIT:Checking   -100.00 USD
+          Assets:DIT:Savings     100.00 USD
+        
+        2000-03-03 * "Deposit" #DEPOSITED ^deposited-1
+          Assets:Checking        100.00 USD
+          Assets:DIT:Savings    -100.00 USD
+        """, entries)
+
+
+def make_note(day, lineno):
+    return data.Note(data.new_metadata('test', lineno),
+                     datetime.date(2000, 1, day), 'Assets:Checking', 'note')
+
+
+@pytest.mark.parametrize('entry_days,new_entry_days', [
+    ([], [3, 1]),
+    ([1, 2, 2, 5], []),
+    ([1, 2, 2, 5], [2, 6, 1, 2]),
+    ([5, 2, 1], [3]),
+])
+def test_merge_entries(entry_days, new_entry_days):
+    # Same-day notes share their line number to check the ties are stable
+    entries = [make_note(day, day) for day in entry_days]
+    new_entries = [make_note(day, day) for day in new_entry_days]
+    merged_entries = deposit_in_transit.merge_entries(entries, new_entries)
+    expected_entries = sorted(entries + new_entries, key=data.entry_sortkey)
+    assert [id(entry) for entry in merged_entries] == [id(entry) for entry in expected_entries]
+
+
+def test_deterministic_links():
+    ledger = """
+plugin "beansoup.plugins.deposit_in_transit" "--auto_open --same_day_merge"
+
+2000-01-01 open Assets:Checking
+2000-01-01 open Assets:Savings
+
+2000-03-02 * "Transfer"
+  Assets:Savings         -100.00 USD
+  Assets:DIT:Checking
+
+2000-03-03 * "Deposit"
+  Assets:Checking         100.00 USD
+  Assets:DIT:Savings
+
+2000-03-04 * "Transfer"
+  Assets:Savings          -50.00 USD
+  Assets:DIT:Checking
+
+2000-03-05 * "Deposit"
+  Assets:Checking          50.00 USD
+  Assets:DIT:Savings
+"""
+    entries, errors, _ = loader.load_string(ledger)
+    assert not errors
+    links = [entry.links for entry in entries if isinstance(entry, data.Transaction)]
+    assert all(len(entry_links) == 1 for entry_links in links)
+    assert len(set().union(*links)) == 2
+    assert links == [entry.links for entry in loader.load_string(ledger)[0]
+                     if isinstance(entry, data.Transaction)]
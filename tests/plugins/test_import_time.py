@@ -0,0 +1,54 @@
+"""Import-time budget of the beansoup plugins."""
+
+import subprocess
+import sys
+import pytest
+
+
+# Plugins are imported by the ledger loader, which has already imported
+# most of beancount and of the standard library by then.
+PRELOAD = 'beancount.loader'
+
+# The budget, in microseconds, for the cumulative import time of a plugin
+# module after the loader; the modules take about 10 to 20ms to import
+# (including compiling them without a bytecode cache).
+BUDGET = 50000
+
+# Modules that should only be imported when a plugin needs them; the loader
+# does not import them.
+CLEAR_TRANSACTIONS_DEFERRED = ['beansoup.utils.dates', 'calendar']
+DEPOSIT_IN_TRANSIT_DEFERRED = []
+
+
+def import_module(module):
+    """Import a module in a new interpreter, after the preloaded one.
+
+    Returns:
+      A pair of a dict mapping the names of the imported modules to their
+      cumulative import time (in microseconds), and a list of the sets of
+      the names of the modules loaded after importing the preloaded module
+      and after importing the given one.
+    """
+    script = ('import sys; import {}; print(" ".join(sys.modules)); '
+              'import {}; print(" ".join(sys.modules))').format(PRELOAD, module)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    import_times = {}
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            import_times[fields[2].strip()] = int(fields[1])
+    return import_times, [set(line.split()) for line in process.stdout.splitlines()]
+
+
+@pytest.mark.parametrize('module,deferred_modules', [
+    ('beansoup.plugins.clear_transactions', CLEAR_TRANSACTIONS_DEFERRED),
+    ('beansoup.plugins.deposit_in_transit', DEPOSIT_IN_TRANSIT_DEFERRED),
+    ('beansoup.plugins.combined', CLEAR_TRANSACTIONS_DEFERRED + DEPOSIT_IN_TRANSIT_DEFERRED),
+])
+def test_import_time(module, deferred_modules):
+    import_times, (preloaded_modules, loaded_modules) = import_module(module)
+    assert import_times[module] < BUDGET
+    assert not preloaded_modules.intersection(deferred_modules)
+    assert not loaded_modules.intersection(deferred_modules)
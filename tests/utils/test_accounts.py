@@ -0,0 +1,36 @@
+"""Unit tests for beansoup.utils.accounts module."""
+
+import pytest
+
+from beansoup.utils import accounts
+
+
+def test_account_map_caches_values():
+    calls = []
+
+    def function(account_name):
+        calls.append(account_name)
+        return len(account_name)
+
+    lengths = accounts.AccountMap(function)
+    assert lengths['Assets:Checking'] == 15
+    assert lengths['Assets:Checking'] == 15
+    assert calls == ['Assets:Checking']
+
+
+@pytest.mark.parametrize('account_name,expected', [
+    ('Assets:DIT:Checking', True),
+    ('Assets:Checking', False),
+    ('Assets:DITTO', False),
+])
+def test_has_component_map(account_name, expected):
+    assert accounts.has_component_map('DIT')[account_name] is expected
+
+
+@pytest.mark.parametrize('account_name,expected', [
+    ('Assets:DIT:Checking', 'Assets:Checking'),
+    ('Liabilities:DIT:Visa', 'Liabilities:Visa'),
+    ('Assets:Checking', 'Assets:Checking'),
+])
+def test_remove_component_map(account_name, expected):
+    assert accounts.remove_component_map('DIT')[account_name] == expected
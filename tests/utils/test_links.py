@@ -4,6 +4,8 @@ import itertools
 import pytest
 import re
 
+from beancount import loader
+
 from beansoup.utils import links
 
 
@@ -23,3 +25,24 @@ def test_uuid_count():
         flags=re.IGNORECASE)
     for link in itertools.islice(links.count(), 10):
         assert uuid_re.match(link)
+
+
+def test_digest():
+    entries = loader.load_string("""
+2016-01-01 open Assets:Checking
+2016-01-01 open Expenses:Food
+
+2016-01-02 * "Groceries"
+  Assets:Checking  -10.00 USD
+  Expenses:Food
+
+2016-01-03 * "Groceries"
+  Assets:Checking  -10.00 USD
+  Expenses:Food
+""")[0]
+    txns = entries[-2:]
+    digest = links.digest(*txns)
+    assert re.match(r'^[0-9a-f]{32}$', digest)
+    assert links.digest(*txns) == digest
+    assert links.digest(*reversed(txns)) != digest
+    assert links.digest(txns[0]) != links.digest(txns[1])
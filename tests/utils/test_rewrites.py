@@ -0,0 +1,52 @@
+"""Unit tests for beansoup.utils.rewrites module."""
+
+import pytest
+
+from beancount.core import data
+
+from beansoup.utils import rewrites
+
+
+def make_txn(lineno, tags=None, links=None, flag='*'):
+    return data.Transaction(data.new_metadata('test', lineno), None, flag,
+                            None, 'narration', tags, links, [])
+
+
+def test_changes_are_accumulated():
+    rewriter = rewrites.EntryRewriter()
+    txn = make_txn(1, tags=frozenset(['TAG']), links=frozenset(['link']))
+    rewriter.add_tags(txn, 'CLEARED')
+    rewriter.add_links(txn, 'cleared-1')
+    rewriter.add_tags(txn, 'PENDING')
+    rewriter.set_flag(txn, '!')
+    new_txn = rewriter.rewrite(txn)
+    assert new_txn.flag == '!'
+    assert new_txn.tags == {'TAG', 'CLEARED', 'PENDING'}
+    assert new_txn.links == {'link', 'cleared-1'}
+    assert new_txn.meta is txn.meta
+    assert rewriter.rewrite(txn) is txn
+
+
+@pytest.mark.parametrize('tags', [None, frozenset(), frozenset(['TAG']), {'TAG'}])
+def test_tags_are_shared(tags):
+    rewriter = rewrites.EntryRewriter()
+    txns = [make_txn(lineno, tags=tags and set(tags)) for lineno in range(3)]
+    for txn in txns:
+        rewriter.add_tags(txn, 'CLEARED')
+    new_txns = [new_txn for _, new_txn in rewriter.rewrite_all()]
+    assert new_txns[0].tags == (tags or set()) | {'CLEARED'}
+    assert all(new_txn.tags is new_txns[0].tags for new_txn in new_txns)
+    assert isinstance(new_txns[0].tags, frozenset)
+
+
+def test_rewrite_all():
+    rewriter = rewrites.EntryRewriter()
+    txns = [make_txn(lineno) for lineno in range(3)]
+    rewriter.set_flag(txns[2], '!')
+    rewriter.set_flag(txns[0], '*')
+    rewritten = list(rewriter.rewrite_all())
+    assert [txn for txn, _ in rewritten] == [txns[2], txns[0]]
+    assert rewritten[0][1].flag == '!'
+    # Unchanged entries are not copied
+    assert rewritten[1][1] is txns[0]
+    assert list(rewriter.rewrite_all()) == []